@@ -0,0 +1,37 @@
+import os
+from feature_functions import *
+from backtest_functions import *
+from sweep_functions import *
+
+preprocessed_data_folder = 'preprocessed_data'
+
+# The worker processes used by run_sweep re-import this script, so everything that
+# runs here is behind the main guard
+if __name__ == '__main__':
+    #####################################################################
+    # Backtest a simple momentum strategy: long when the close is above
+    # its level an hour ago, short when it is below
+    symbol = 'BTCUSD'
+    exchange = 'coinbase'
+    interval = '1m'
+
+    historical_data = load_features(symbol, exchange, ['open', 'close', 'return_60'], interval, folder=preprocessed_data_folder)
+    positions = np.sign(historical_data['return_60'].to_numpy())
+
+    backtest = run_backtest(historical_data, positions, fee=0.001, slippage=0.0005)
+
+    print(f"{symbol} on {exchange}, {interval} momentum")
+    for stat, value in backtest['stats'].items():
+        print(f"{stat}: {value:.4f}")
+
+    #####################################################################
+    # Sweep the moving average crossover over the 1h rollups of every 
+    # symbol and exchange, in walk-forward windows of one year of training
+    # and one quarter of testing. Rerunning continues an interrupted sweep
+    results_file = os.path.join('backtest_results', 'sma_crossover_1h.jsonl')
+
+    params_list = parameter_grid({'fast': [5, 10, 20, 50], 'slow': [50, 100, 200, 400]}, lambda params: params['fast'] < params['slow'])
+    run_sweep('sma_crossover', params_list, results_file, interval='1h', train_days=365, test_days=90,
+              workers=os.cpu_count(), folder=preprocessed_data_folder, stage='rollup')
+
+    print(walk_forward_report(results_file, metric='sharpe'))
@@ -0,0 +1,156 @@
+import numpy as np
+import polars as pl
+from exchange_maps import *
+from storage_functions import *
+
+# A backtest takes candles and a target position per candle (a fraction of equity,
+# negative for short), decided at the close of the candle. Returns, trading costs and
+# the equity curve are computed with array operations over all candles at once.
+
+seconds_per_year = 365 * 24 * 60 * 60
+
+# Below this many days the CAGR is NaN, as annualizing the return of a few candles
+# overflows or means nothing
+min_cagr_days = 1
+
+
+#------------------------------------------------------------
+# Backtest
+
+def _positions_array(historical_data, positions):
+    # A column of historical_data, or anything numpy can turn into one value per candle
+    if isinstance(positions, str):
+        positions = historical_data[positions]
+    if isinstance(positions, pl.Series):
+        positions = positions.to_numpy()
+
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.shape != (historical_data.height,):
+        raise ValueError(f"Expected one position per candle ({historical_data.height}), got shape {positions.shape}")
+
+    return np.nan_to_num(positions, nan=0.0)
+
+def run_backtest(historical_data, positions, fee=0.001, slippage=0.0005, execution='next_open', initial_equity=1.0):
+    '''
+    Backtest a series of target positions on one asset.
+
+    :param historical_data: Candles sorted by start, with at least start, open and close,
+        e.g. from load_klines or load_features, or the path of a dataset
+    :param positions: Target position per candle as a fraction of equity (1 is fully long,
+        -1 fully short, NaN is flat), as an array, a Series or a column name of
+        historical_data. The position for a candle is decided at its close.
+    :param fee: Fee per trade as a fraction of the traded notional
+    :param slippage: Price slippage per trade as a fraction of the price, against the trade
+    :param execution: 'next_open' fills at the open of the next candle, 'close' at the close
+        of the candle the position was decided at
+    :param initial_equity: Equity at the start
+    :return: Dict with 'equity' (DataFrame with start, position held at the close, net
+        return, equity and drawdown per candle), 'trades' (DataFrame with the time, position
+        change, price, fill price and cost of every fill) and 'stats' (see backtest_stats)
+    '''
+    if isinstance(historical_data, str):
+        historical_data = read_dataset(historical_data, columns=['start', 'open', 'close']).sort(by='start')
+
+    target = _positions_array(historical_data, positions)
+    start = historical_data['start'].to_numpy()
+    open_ = historical_data['open'].to_numpy().astype(np.float64)
+    close = historical_data['close'].to_numpy().astype(np.float64)
+    n_candles = len(start)
+    step = int(start[1] - start[0]) if n_candles > 1 else 60
+
+    previous_close = np.concatenate([close[:1], close[:-1]])
+    cost_rate = fee + slippage
+
+    # held[i] is the position after the fills of candle i, at its close
+    if execution == 'close':
+        held = target
+        previous_held = np.concatenate([[0.0], held[:-1]])
+        traded = held - previous_held
+        growth = (1 + previous_held * (close / previous_close - 1)) * (1 - np.abs(traded) * cost_rate)
+        fill_price = close
+    elif execution == 'next_open':
+        held = np.concatenate([[0.0], target[:-1]])
+        previous_held = np.concatenate([[0.0], held[:-1]])
+        traded = held - previous_held
+        # The old position is held from the previous close to the open, the new one from
+        # the open to the close
+        growth = (1 + previous_held * (open_ / previous_close - 1)) * (1 - np.abs(traded) * cost_rate) * (1 + held * (close / open_ - 1))
+        fill_price = open_
+    else:
+        raise ValueError(f"Unknown execution: {execution}")
+
+    returns = growth - 1
+    equity = initial_equity * np.cumprod(growth)
+    drawdown = equity / np.maximum.accumulate(equity) - 1
+
+    fills = np.flatnonzero(traded != 0)
+    equity_before = np.concatenate([[initial_equity], equity[:-1]])[fills]
+    trades = pl.DataFrame({
+        'time': start[fills] + (step if execution == 'close' else 0),
+        'position_before': previous_held[fills],
+        'position_after': held[fills],
+        'price': fill_price[fills],
+        'fill_price': fill_price[fills] * (1 + slippage * np.sign(traded[fills])),
+        'cost': equity_before * np.abs(traded[fills]) * cost_rate
+    })
+
+    equity_curve = pl.DataFrame({
+        'start': start,
+        'position': held,
+        'return': returns,
+        'equity': equity,
+        'drawdown': drawdown
+    })
+
+    return {
+        'equity': equity_curve,
+        'trades': trades,
+        'stats': backtest_stats(equity_curve, trades, step, initial_equity)
+    }
+
+#------------------------------------------------------------
+# Statistics
+
+def backtest_stats(equity_curve, trades, step, initial_equity=1.0):
+    '''
+    Standard statistics of a backtest. Returns and volatility are annualized from the
+    candle interval step (in seconds), with a risk-free rate of 0. The CAGR is NaN for
+    backtests shorter than min_cagr_days.
+
+    :return: Dict with the total return, CAGR, annualized volatility, Sharpe and Sortino
+        ratios, max drawdown and its duration in days, the number of fills, turnover (sum
+        of position changes), total cost, exposure (share of candles with a position) and
+        hit rate (share of candles with a position that made money)
+    '''
+    returns = equity_curve['return'].to_numpy()
+    equity = equity_curve['equity'].to_numpy()
+    position = equity_curve['position'].to_numpy()
+    periods_per_year = seconds_per_year / step
+    years = len(returns) * step / seconds_per_year
+
+    if len(returns) == 0:
+        return {}
+
+    mean_return = returns.mean()
+    volatility = returns.std()
+    downside = np.sqrt(np.mean(np.minimum(returns, 0) ** 2))
+
+    # Candles since the last equity high, at every candle
+    is_high = equity >= np.maximum.accumulate(equity)
+    last_high = np.maximum.accumulate(np.where(is_high, np.arange(len(equity)), 0))
+    in_market = position != 0
+
+    return {
+        'total_return': equity[-1] / initial_equity - 1,
+        'cagr': np.nan if years * 365 < min_cagr_days else ((equity[-1] / initial_equity) ** (1 / years) - 1 if equity[-1] > 0 else -1.0),
+        'volatility': volatility * np.sqrt(periods_per_year),
+        'sharpe': mean_return / volatility * np.sqrt(periods_per_year) if volatility > 0 else 0.0,
+        'sortino': mean_return / downside * np.sqrt(periods_per_year) if downside > 0 else 0.0,
+        'max_drawdown': equity_curve['drawdown'].min(),
+        'max_drawdown_days': (np.arange(len(equity)) - last_high).max() * step / 86400,
+        'fills': trades.height,
+        'turnover': float(np.abs(trades['position_after'] - trades['position_before']).sum()),
+        'cost': float(trades['cost'].sum()),
+        'exposure': in_market.mean(),
+        'hit_rate': (returns[in_market] > 0).mean() if in_market.any() else 0.0
+    }
@@ -0,0 +1,38 @@
+from benchmark_functions import *
+
+# Everything that runs here is behind the main guard, so that importing this script 
+# (e.g. from a spawned worker process) does not start every benchmark
+if __name__ == '__main__':
+    #####################################################################
+    # CPU time per get_historical_klines step spent decoding the raw 
+    # response bodies into one DataFrame, through Python objects and a 
+    # DataFrame per page versus straight to columns
+    benchmark_kline_decoding()
+
+    #####################################################################
+    # End-to-end ingestion throughput of every exchange adapter against 
+    # a local mock exchange server, without and with network faults
+    benchmark_ingestion()
+    benchmark_ingestion(latency=0.02, gap_probability=0.001, rate_limit_probability=0.01, drop_probability=0.01)
+
+    #####################################################################
+    # Iterative versus single pass outlier removal on 5 years of 1m data
+    benchmark_remove_outliers()
+
+    #####################################################################
+    # Time, throughput and peak memory of every preprocessing stage on 
+    # 1, 3 and 8 years of synthetic 1m data, compared with the baseline
+    benchmark_preprocessing()
+
+    #####################################################################
+    # Time of a 5 year 1m single asset backtest
+    benchmark_backtest()
+
+    #####################################################################
+    # Size on disk and read speed of the CSV and Parquet storage formats
+    benchmark_storage_formats()
+
+    #####################################################################
+    # Cold start time of the modules, which must not need network access
+    # or GCP credentials to import
+    benchmark_import_time()
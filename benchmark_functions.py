@@ -0,0 +1,573 @@
+import io
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+import subprocess
+import tempfile
+import numpy as np
+import polars as pl
+from import_historical_data_functions import *
+from preprocess_data_functions import *
+from mock_exchange_server import *
+from backtest_functions import *
+
+
+#------------------------------------------------------------
+# Synthetic data
+
+def synthetic_klines(years=1, n_spikes=0, gap_density=0.0, start_unix=1577836800, seed=0):
+    """
+    Build a 1m OHLCV DataFrame following a random walk, with the same columns as 
+    the raw data files. Spikes are single candles whose close jumps by 20-50% and 
+    reverts on the next candle, the pattern remove_outliers looks for.
+
+    :param years: Length of the data in years (365-day years)
+    :param n_spikes: Number of spike-and-revert candles to inject
+    :param gap_density: Share of candles to leave out, as if the exchange never sent them 
+        (the first and last candle are always kept)
+    :param start_unix: Timestamp of the first candle in seconds
+    :param seed: Seed for the random prices
+    :return: DataFrame with the columns start, low, high, open, close, volume
+    """
+    rng = np.random.default_rng(seed)
+    n_candles = int(years * 365 * 24 * 60)
+
+    close = 10000 * np.exp(np.cumsum(rng.normal(0, 0.001, n_candles)))
+    open_ = np.concatenate([[close[0]], close[:-1]])
+
+    spikes = rng.choice(np.arange(1, n_candles - 1), size=n_spikes, replace=False)
+    close[spikes] *= 1 + rng.choice([-1, 1], size=n_spikes) * rng.uniform(0.2, 0.5, size=n_spikes)
+
+    historical_data = pl.DataFrame({
+        "start": start_unix + 60 * np.arange(n_candles, dtype=np.int64),
+        "low": np.minimum(open_, close) * (1 - rng.exponential(0.0005, n_candles)),
+        "high": np.maximum(open_, close) * (1 + rng.exponential(0.0005, n_candles)),
+        "open": open_,
+        "close": close,
+        "volume": rng.exponential(5, n_candles)
+    })
+
+    if gap_density > 0:
+        keep = rng.random(n_candles) >= gap_density
+        keep[[0, -1]] = True
+        historical_data = historical_data.filter(pl.Series(keep))
+
+    return historical_data
+
+def synthetic_kline_pages(exchange, n_candles, start_unix=1640995200, seed=0):
+    """
+    Build the pages an exchange's kline endpoint would return for n_candles
+    consecutive 1m candles, in the exchange's own row layout and page order.
+
+    :param exchange: The exchange whose response format should be imitated
+    :param n_candles: Total number of candles over all pages
+    :param start_unix: Timestamp of the first candle in seconds
+    :param seed: Seed for the random prices
+    :return: List of pages, as passed to legacy_klines_from_pages
+    """
+    rng = np.random.default_rng(seed)
+    page_format = kline_page_formats[exchange]
+    page_limit = exchange_page_limits[exchange]
+
+    close = 30000 * np.exp(np.cumsum(rng.normal(0, 0.001, n_candles)))
+    fields = {
+        "start": start_unix + 60 * np.arange(n_candles),
+        "open": np.concatenate([[close[0]], close[:-1]]),
+        "close": close,
+        "volume": rng.exponential(5, n_candles)
+    }
+    fields["high"] = np.maximum(fields["open"], close) * (1 + rng.exponential(0.0005, n_candles))
+    fields["low"] = np.minimum(fields["open"], close) * (1 - rng.exponential(0.0005, n_candles))
+
+    if page_format['start_in_ms']:
+        fields["start"] = fields["start"] * 1000
+
+    rows = []
+    for i in range(n_candles):
+        row = []
+        for column in page_format['columns']:
+            if column == "start":
+                # Binance and Digifinex send timestamps as numbers, everyone else as strings
+                value = int(fields["start"][i]) if exchange in ['binance', 'digifinex'] else str(fields["start"][i])
+            elif column in fields:
+                value = float(fields[column][i]) if exchange == 'digifinex' else f"{fields[column][i]:.2f}"
+            else:
+                value = 0 if exchange == 'binance' else "0"
+            row.append(value)
+
+        if exchange == 'coinbase':
+            row = dict(zip(page_format['columns'], row))
+        rows.append(row)
+
+    pages = [rows[i:i + page_limit] for i in range(0, n_candles, page_limit)]
+    if page_format['newest_first']:
+        pages = [page[::-1] for page in pages]
+
+    return pages
+
+def synthetic_kline_payloads(exchange, n_candles, start_unix=1640995200, seed=0):
+    """
+    Build the raw response bodies an exchange's kline endpoint would return for 
+    n_candles consecutive 1m candles: the pages of synthetic_kline_pages wrapped in 
+    the exchange's response envelope and encoded as JSON.
+
+    :param exchange: The exchange whose responses should be imitated
+    :param n_candles: Total number of candles over all pages
+    :param start_unix: Timestamp of the first candle in seconds
+    :param seed: Seed for the random prices
+    :return: List of response bodies (bytes), as passed to klines_from_payloads
+    """
+    payloads = []
+
+    for page in synthetic_kline_pages(exchange, n_candles, start_unix=start_unix, seed=seed):
+        for key in reversed(kline_page_formats[exchange]['rows_path']):
+            page = {key: page}
+        payloads.append(json.dumps(page, separators=(',', ':')).encode())
+
+    return payloads
+
+#------------------------------------------------------------
+# Kline decoding
+
+def legacy_klines_from_pages(pages, exchange):
+    """
+    The page handling the get_klines_subset_* fetchers used before klines_from_payloads:
+    every page is turned into its own DataFrame, cast, and vstacked onto the result.
+    Kept only as the baseline for benchmark_kline_decoding.
+    """
+    page_format = kline_page_formats[exchange]
+    columns = [column for column in ["start", "low", "high", "open", "close", "volume"] if column in page_format['columns']]
+
+    df_klines = pl.DataFrame()
+
+    for page in pages:
+        if len(page) > 0:
+            if exchange == 'coinbase':
+                df_page = pl.DataFrame(page)
+            else:
+                df_page = pl.DataFrame(page, schema=page_format['columns'], orient="row")
+
+            if page_format['newest_first']:
+                df_page = df_page.reverse()
+
+            df_page = df_page.select(columns).with_columns([pl.col(column).cast(pl.Float64) for column in columns[1:]] + [
+                pl.col("start").cast(pl.Int64)
+            ])
+
+            if page_format['start_in_ms']:
+                df_page = df_page.with_columns((pl.col("start") / 1000).alias("start").cast(pl.Int64))
+
+            df_klines = df_klines.vstack(df_page)
+
+    return df_klines
+
+def legacy_klines_from_payloads(payloads, exchange):
+    """
+    Decoding the fetchers did before klines_from_payloads: every response is parsed into
+    Python objects with json.loads, and the rows are then handed to
+    legacy_klines_from_pages.
+    """
+    pages = []
+
+    for payload in payloads:
+        page = json.loads(payload)
+        for key in kline_page_formats[exchange]['rows_path']:
+            page = page[key]
+        pages.append(page)
+
+    return legacy_klines_from_pages(pages, exchange)
+
+def benchmark_kline_decoding(exchanges=None, step_size=5, repeats=5):
+    """
+    Compare the CPU time needed to turn one get_historical_klines step worth of raw 
+    response bodies into a DataFrame, the way the fetchers used to (json.loads, then a 
+    DataFrame per page, see legacy_klines_from_payloads) versus parsed by Polars straight 
+    into columns (klines_from_payloads, as the fetchers do now). Both results are checked 
+    to be identical.
+
+    :param exchanges: List of exchanges to benchmark (default: all)
+    :param step_size: Days of 1m candles per step, as in get_historical_klines
+    :param repeats: Number of timed runs per exchange, the fastest of which is reported
+    :return: DataFrame with the CPU time per step before and after, in milliseconds
+    """
+    exchanges = exchanges or list(kline_page_formats.keys())
+    n_candles = step_size * 24 * 60
+
+    results = []
+
+    for exchange in exchanges:
+        payloads = synthetic_kline_payloads(exchange, n_candles)
+
+        timings = {}
+        for name, decode in [('before', legacy_klines_from_payloads), ('after', klines_from_payloads)]:
+            cpu_times = []
+            for _ in range(repeats):
+                cpu_start = time.process_time()
+                df_klines = decode(payloads, exchange)
+                cpu_times.append(time.process_time() - cpu_start)
+            timings[name] = min(cpu_times)
+            timings[name + '_df'] = df_klines
+
+        if not timings['before_df'].equals(timings['after_df'].select(timings['before_df'].columns)):
+            raise AssertionError(f"Decoded klines differ for {exchange}")
+
+        results.append({
+            'exchange': exchange,
+            'pages': len(payloads),
+            'candles': n_candles,
+            'mb': round(sum(len(payload) for payload in payloads) / 1e6, 2),
+            'cpu_ms_before': round(1000 * timings['before'], 2),
+            'cpu_ms_after': round(1000 * timings['after'], 2),
+            'speedup': round(timings['before'] / max(timings['after'], 1e-9), 1)
+        })
+
+    results = pl.DataFrame(results)
+    print(f"CPU time per {step_size}-day step spent decoding the kline responses")
+    print(results)
+
+    return results
+
+#------------------------------------------------------------
+# Ingestion
+
+def benchmark_ingestion(exchanges=None, days=10, symbol='BTCUSD', rate_limited=False, **mock_config):
+    """
+    Run get_historical_klines end to end against the mock exchange server, for each
+    exchange adapter in turn, and measure its throughput. The server runs in its own
+    process, so the CPU time reported is that of the ingestion path alone (requests,
+    decoding and writing the partial dataset).
+
+    :param exchanges: List of exchanges to benchmark (default: all)
+    :param days: Days of 1m candles to download per exchange
+    :param symbol: The symbol to download, as in symbol_map
+    :param rate_limited: Keep exchange_rate_limits in place. By default they are set to
+        zero, so that the adapters themselves are measured rather than the limits
+    :param mock_config: Passed on to the mock exchange server, e.g. latency=0.05,
+        gap_probability=0.01, rate_limit_probability=0.01, drop_probability=0.01
+    :return: DataFrame with candles/s, requests/s and CPU microseconds per candle per exchange
+    """
+    exchanges = exchanges or list(kline_page_formats.keys())
+    start_date, end_date = '2023-01-01', (datetime(2023, 1, 1) + timedelta(days=days)).strftime('%Y-%m-%d')
+
+    process, port = start_mock_exchange_process(**mock_config)
+    previous_urls = use_mock_exchange_server(port)
+    previous_rate_limits = dict(exchange_rate_limits)
+    previous_cache_mode = response_cache_mode
+    package_dir = os.getcwd()
+
+    if not rate_limited:
+        exchange_rate_limits.update({exchange: 0.0 for exchange in exchange_rate_limits})
+    set_response_cache('off')
+
+    results = []
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            os.makedirs('historical_data')
+
+            for exchange in exchanges:
+                requests_before = request_count()
+                wall_start = time.perf_counter()
+                cpu_start = time.process_time()
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    get_historical_klines(symbol, '1m', start_date, end_date, exchange)
+
+                cpu_time = time.process_time() - cpu_start
+                wall_time = time.perf_counter() - wall_start
+                n_requests = request_count() - requests_before
+
+                raw_path = dataset_path('historical_data', exchange, symbol_map[symbol][exchange], '1m', 'raw')
+                candles = read_dataset(raw_path, columns=['start'])['start'].n_unique()
+
+                results.append({
+                    'exchange': exchange,
+                    'candles': candles,
+                    'requests': n_requests,
+                    'wall_s': round(wall_time, 2),
+                    'candles_per_s': round(candles / wall_time),
+                    'requests_per_s': round(n_requests / wall_time, 1),
+                    'cpu_us_per_candle': round(1e6 * cpu_time / max(candles, 1), 2)
+                })
+    finally:
+        os.chdir(package_dir)
+        exchange_api_urls.update(previous_urls)
+        exchange_rate_limits.update(previous_rate_limits)
+        set_response_cache(previous_cache_mode)
+        process.terminate()
+
+    results = pl.DataFrame(results)
+    print(f"Ingestion of {days} day(s) of 1m candles from the mock exchange server {mock_config or ''}")
+    print(results)
+
+    return results
+
+#------------------------------------------------------------
+# Outlier removal
+
+def benchmark_remove_outliers(years=5, n_spikes=200, max_change=0.15):
+    """
+    Time the iterative and sweep implementations of remove_outliers on synthetic 1m 
+    data with injected spike-and-revert candles, and check that they remove the same 
+    rows.
+
+    :param years: Length of the synthetic data in years
+    :param n_spikes: Number of injected spikes
+    :param max_change: Passed on to remove_outliers
+    :return: DataFrame with the wall time in seconds per method
+    """
+    historical_data = synthetic_klines(years, n_spikes=n_spikes)
+
+    results = []
+    cleaned = {}
+
+    for method in ['iterative', 'sweep']:
+        wall_start = time.perf_counter()
+        cleaned[method] = remove_outliers(historical_data, max_change=max_change, method=method)
+        wall_time = time.perf_counter() - wall_start
+
+        results.append({
+            'method': method,
+            'rows': historical_data.height,
+            'rows_removed': historical_data.height - cleaned[method].height,
+            'wall_s': round(wall_time, 3)
+        })
+
+    if not cleaned['iterative'].equals(cleaned['sweep']):
+        raise AssertionError("Sweep and iterative outlier removal returned different rows")
+
+    results = pl.DataFrame(results)
+    print(f"remove_outliers on {years} year(s) of 1m data with {n_spikes} spikes")
+    print(results)
+
+    return results
+
+#------------------------------------------------------------
+# Preprocessing
+
+preprocessing_stages = ['remove_outliers', 'impute_missing_data', 'add_derived_columns', 'end_to_end']
+
+def _run_preprocessing_stage(stage, years, gap_density, n_spikes):
+    # Run in a fresh interpreter per stage by benchmark_preprocessing, so that the peak
+    # RSS is that of this stage and its input alone
+    historical_data = synthetic_klines(years, n_spikes=n_spikes, gap_density=gap_density)
+
+    if stage in ['impute_missing_data', 'add_derived_columns']:
+        historical_data = remove_outliers(historical_data)
+    if stage == 'add_derived_columns':
+        historical_data = impute_missing_data(historical_data)
+
+    run_stage = {
+        'remove_outliers': remove_outliers,
+        'impute_missing_data': impute_missing_data,
+        'add_derived_columns': add_derived_columns,
+        'end_to_end': preprocess_historical_data
+    }[stage]
+
+    input_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start_time = time.perf_counter()
+    run_stage(historical_data)
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'rows': historical_data.height,
+        'seconds': seconds,
+        'input_rss_mb': input_rss_mb,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+def benchmark_preprocessing(years=(1, 3, 8), gap_density=0.01, spikes_per_year=40, stages=None,
+                            baseline_file=os.path.join('benchmark_baselines', 'preprocessing.json'), update_baseline=False):
+    """
+    Time every preprocessing stage on its own and preprocess_historical_data end to 
+    end, on synthetic 1m data of several lengths with gaps and outlier spikes. Every 
+    stage runs in a fresh interpreter, and its input is built there before the timer 
+    starts. Results are compared with the baseline stored in baseline_file, which is 
+    written on the first run (or when update_baseline is set).
+
+    :param years: Lengths of the synthetic data in years
+    :param gap_density: Share of candles missing from the synthetic data
+    :param spikes_per_year: Number of outlier spikes injected per year of data
+    :param stages: List of stages to run (default: preprocessing_stages)
+    :param baseline_file: JSON file holding the baseline results
+    :param update_baseline: Replace the stored baseline with this run's results
+    :return: DataFrame with the time, throughput and peak RSS per stage and length, and 
+        the change in time and peak RSS relative to the baseline in percent
+    """
+    stages = stages or preprocessing_stages
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    baseline = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+
+    results = []
+
+    for n_years in years:
+        for stage in stages:
+            code = f"import json, benchmark_functions; " + \
+                f"print(json.dumps(benchmark_functions._run_preprocessing_stage({stage!r}, {n_years}, {gap_density}, {int(spikes_per_year * n_years)})))"
+            output = subprocess.run([sys.executable, '-c', code], cwd=package_dir, check=True, capture_output=True, text=True).stdout
+            run = json.loads(output.strip().splitlines()[-1])
+
+            key = f"{stage}_{n_years}y"
+            result = {
+                'stage': stage,
+                'years': n_years,
+                'rows': run['rows'],
+                'seconds': round(run['seconds'], 3),
+                'rows_per_s': round(run['rows'] / run['seconds']),
+                'input_rss_mb': round(run['input_rss_mb']),
+                'peak_rss_mb': round(run['peak_rss_mb']),
+                'seconds_change_pct': None,
+                'peak_rss_change_pct': None
+            }
+
+            if key in baseline:
+                result['seconds_change_pct'] = round(100 * (result['seconds'] / baseline[key]['seconds'] - 1), 1)
+                result['peak_rss_change_pct'] = round(100 * (result['peak_rss_mb'] / baseline[key]['peak_rss_mb'] - 1), 1)
+
+            if update_baseline or key not in baseline:
+                baseline[key] = {column: result[column] for column in ['rows', 'seconds', 'rows_per_s', 'peak_rss_mb']}
+
+            results.append(result)
+
+    os.makedirs(os.path.dirname(baseline_file) or '.', exist_ok=True)
+    with open(baseline_file, 'w') as f:
+        json.dump(baseline, f, indent=4, sort_keys=True)
+
+    results = pl.DataFrame(results, schema_overrides={'seconds_change_pct': pl.Float64, 'peak_rss_change_pct': pl.Float64})
+    print(f"Preprocessing of synthetic 1m data with {100 * gap_density}% gaps and {spikes_per_year} spikes per year" +
+          f" (changes relative to {baseline_file})")
+    with pl.Config(tbl_cols=-1, tbl_width_chars=200):
+        print(results)
+
+    return results
+
+#------------------------------------------------------------
+# Storage formats
+
+def _disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+
+def benchmark_storage_formats(years=1, repeats=3):
+    """
+    Compare the single-CSV and partitioned Parquet storage formats on a synthetic
+    complete dataset (OHLCV, as written by preprocess_data):
+    size on disk, time to read the whole dataset and time to read only 'close'.
+
+    :param years: Length of the synthetic dataset in years
+    :param repeats: Number of timed reads per format, the fastest of which is reported
+    :return: DataFrame with one row per storage format
+    """
+    complete_data = synthetic_klines(years)
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        for storage_format in ['csv', 'parquet']:
+            path = dataset_path(folder, 'coinbase', 'BTC-USD', '1m', 'complete', storage_format=storage_format)
+
+            write_start = time.perf_counter()
+            write_dataset(complete_data, path)
+            write_time = time.perf_counter() - write_start
+
+            read_times = {'all': [], 'close': []}
+            for _ in range(repeats):
+                for columns_read, columns in [('all', None), ('close', ['start', 'close'])]:
+                    read_start = time.perf_counter()
+                    read_dataset(path, columns=columns)
+                    read_times[columns_read].append(time.perf_counter() - read_start)
+
+            results.append({
+                'format': storage_format,
+                'rows': complete_data.height,
+                'size_mb': round(_disk_size(path) / 1e6, 1),
+                'write_s': round(write_time, 3),
+                'read_all_s': round(min(read_times['all']), 3),
+                'read_close_s': round(min(read_times['close']), 3)
+            })
+
+    results = pl.DataFrame(results)
+    print(f"Storage formats for {years} year(s) of complete 1m data")
+    print(results)
+
+    return results
+
+#------------------------------------------------------------
+# Backtest
+
+def benchmark_backtest(years=5, repeats=3):
+    """
+    Time run_backtest on synthetic 1m data with a moving average crossover that flips
+    between long and short, for both execution modes.
+
+    :param years: Length of the synthetic data in years
+    :param repeats: Number of timed runs per execution mode, the fastest of which is reported
+    :return: DataFrame with the time and throughput per execution mode
+    """
+    historical_data = synthetic_klines(years)
+    positions = np.sign(historical_data['close'].rolling_mean(60) - historical_data['close'].rolling_mean(600)).to_numpy()
+
+    results = []
+
+    for execution in ['next_open', 'close']:
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            backtest = run_backtest(historical_data, positions, execution=execution)
+            times.append(time.perf_counter() - start_time)
+
+        results.append({
+            'execution': execution,
+            'candles': historical_data.height,
+            'fills': backtest['stats']['fills'],
+            'seconds': round(min(times), 3),
+            'candles_per_s': round(historical_data.height / min(times))
+        })
+
+    results = pl.DataFrame(results)
+    print(f"run_backtest on {years} years of 1m data")
+    print(results)
+
+    return results
+
+#------------------------------------------------------------
+# Import time
+
+def benchmark_import_time(modules=('preprocess_data_functions', 'import_historical_data_functions'), repeats=5):
+    """
+    Measure the cold start time of importing each module in a fresh interpreter,
+    without GCP credentials, next to the time of starting an interpreter that
+    imports nothing.
+
+    :param modules: Names of the modules to import
+    :param repeats: Number of fresh interpreters per module, the fastest of which is reported
+    :return: DataFrame with the wall time in seconds per module
+    """
+    env = {key: value for key, value in os.environ.items() if key != 'gcp_crypto_project'}
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    results = []
+
+    for module in ('',) + tuple(modules):
+        wall_times = []
+        for _ in range(repeats):
+            wall_start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', f'import {module}' if module else 'pass'], cwd=package_dir, env=env, check=True)
+            wall_times.append(time.perf_counter() - wall_start)
+
+        results.append({'module': module or '(interpreter only)', 'import_s': round(min(wall_times), 3)})
+
+    results = pl.DataFrame(results)
+    print("Cold start import time")
+    print(results)
+
+    return results
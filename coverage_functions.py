@@ -0,0 +1,252 @@
+import os
+import json
+import numpy as np
+import polars as pl
+from exchange_maps import *
+from storage_functions import *
+
+# A coverage index records which candles of a dataset have been downloaded, as a sorted
+# list of [first start, last start] runs of consecutive candles (both ends inclusive).
+# It also counts how many times in a row request_missing_data asked the exchange for a
+# range and got nothing back. After unavailable_after_attempts such attempts the range is
+# known to be unavailable and not requested again, while a range that came back empty
+# once, e.g. because of a transient error, is still retried.
+
+unavailable_after_attempts = 3
+
+
+def coverage_path(folder, exchange, symbol_exchange, interval, stage='raw'):
+    '''
+    The raw and partial stages of a dataset each have their own coverage index, and the
+    partial one is merged into the raw one when the partial dataset becomes the raw dataset.
+    '''
+    if stage == 'raw':
+        return os.path.join(folder, f'{exchange}_{symbol_exchange}_{interval}_coverage.json')
+    return os.path.join(folder, f'{exchange}_{symbol_exchange}_{interval}_{stage}_coverage.json')
+
+def empty_coverage(interval):
+    return {'interval': interval, 'covered': [], 'unavailable': [], 'attempts': []}
+
+def load_coverage(folder, exchange, symbol_exchange, interval, stage='raw'):
+    path = coverage_path(folder, exchange, symbol_exchange, interval, stage)
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+def save_coverage(coverage, folder, exchange, symbol_exchange, interval, stage='raw'):
+    path = coverage_path(folder, exchange, symbol_exchange, interval, stage)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(coverage, f)
+    os.replace(path + '.tmp', path)
+
+def runs_from_starts(starts, step):
+    '''
+    Collapse candle start timestamps into [first, last] runs of consecutive candles.
+    '''
+    starts = np.unique(np.asarray(starts, dtype=np.int64))
+    if len(starts) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(starts) != step) + 1
+    firsts = starts[np.concatenate([[0], breaks])]
+    lasts = starts[np.concatenate([breaks - 1, [len(starts) - 1]])]
+
+    return [[int(first), int(last)] for first, last in zip(firsts, lasts)]
+
+def merge_ranges(ranges, step):
+    '''
+    Union of [first, last] ranges, merging ranges that overlap or touch.
+    '''
+    merged = []
+
+    for first, last in sorted(ranges):
+        if len(merged) > 0 and first <= merged[-1][1] + step:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+
+    return merged
+
+def subtract_ranges(ranges, removed_ranges, step):
+    '''
+    The parts of the [first, last] ranges not covered by any of removed_ranges.
+    '''
+    remaining = []
+    removed_ranges = merge_ranges(removed_ranges, step)
+    j = 0
+
+    for first, last in merge_ranges(ranges, step):
+        while j < len(removed_ranges) and removed_ranges[j][1] < first:
+            j += 1
+
+        k = j
+        while first <= last and k < len(removed_ranges) and removed_ranges[k][0] <= last:
+            if removed_ranges[k][0] > first:
+                remaining.append([first, removed_ranges[k][0] - step])
+            first = max(first, removed_ranges[k][1] + step)
+            k += 1
+
+        if first <= last:
+            remaining.append([first, last])
+
+    return remaining
+
+def mark_covered(coverage, starts):
+    step = interval_seconds[coverage['interval']]
+    coverage['covered'] = merge_ranges(coverage['covered'] + runs_from_starts(starts, step), step)
+
+def clip_coverage(coverage, end):
+    '''
+    Leave only the covered candles that start before end (a unix timestamp), e.g. to drop
+    those written after the last checkpoint of an interrupted download.
+    '''
+    step = interval_seconds[coverage['interval']]
+    coverage['covered'] = [[first, min(last, first + (end - 1 - first) // step * step)] for first, last in coverage['covered'] if first < end]
+
+def mark_unavailable(coverage, ranges):
+    step = interval_seconds[coverage['interval']]
+    coverage['unavailable'] = merge_ranges(coverage['unavailable'] + [list(r) for r in ranges], step)
+
+def record_attempts(coverage, ranges, max_attempts=unavailable_after_attempts):
+    '''
+    Count another request for the [first, last] ranges that the exchange returned nothing
+    for. Ranges that reach max_attempts in a row are marked unavailable, and the counts of
+    ranges that are no longer in ranges are dropped.
+    '''
+    step = interval_seconds[coverage['interval']]
+    attempts = []
+
+    for first, last, count in coverage.get('attempts', []):
+        repeated = subtract_ranges([[first, last]], subtract_ranges([[first, last]], ranges, step), step)
+        attempts += [[repeated_first, repeated_last, count + 1] for repeated_first, repeated_last in repeated]
+
+    attempts += [[first, last, 1] for first, last in subtract_ranges(ranges, [attempt[:2] for attempt in attempts], step)]
+    attempts.sort()
+
+    mark_unavailable(coverage, [[first, last] for first, last, count in attempts if count >= max_attempts])
+    coverage['attempts'] = [attempt for attempt in attempts if attempt[2] < max_attempts]
+
+def merge_partial_coverage(folder, exchange, symbol_exchange, interval):
+    '''
+    Make the coverage index of the partial dataset the index of the raw dataset, keeping
+    the attempts and unavailable ranges of the raw index. Called right before the partial
+    dataset is moved to replace the raw dataset.
+    '''
+    partial_coverage = load_coverage(folder, exchange, symbol_exchange, interval, 'partial') or empty_coverage(interval)
+    coverage = load_coverage(folder, exchange, symbol_exchange, interval) or empty_coverage(interval)
+
+    coverage['covered'] = partial_coverage['covered']
+    save_coverage(coverage, folder, exchange, symbol_exchange, interval)
+
+    partial_coverage_path = coverage_path(folder, exchange, symbol_exchange, interval, 'partial')
+    if os.path.isfile(partial_coverage_path):
+        os.remove(partial_coverage_path)
+
+def missing_ranges(coverage, start=None, end=None, include_unavailable=False):
+    '''
+    The [first, last] ranges of candles between start and end (both inclusive, defaulting
+    to the first and last covered candle) that are not covered. Ranges confirmed to be
+    unavailable are left out unless include_unavailable is set.
+    '''
+    step = interval_seconds[coverage['interval']]
+    covered = coverage['covered']
+
+    if len(covered) == 0:
+        return [] if start is None or end is None else [[start, end]]
+
+    start = covered[0][0] if start is None else start
+    end = covered[-1][1] if end is None else end
+
+    missing = subtract_ranges([[start, end]], covered, step)
+
+    if not include_unavailable:
+        missing = subtract_ranges(missing, coverage['unavailable'], step)
+
+    return missing
+
+def coalesce_ranges(ranges, max_candles, step):
+    '''
+    Group [first, last] ranges into as few windows as possible, each spanning at most
+    max_candles candles. Ranges close enough together share a window (which then also
+    spans the candles between them) and ranges longer than max_candles are split.
+    '''
+    windows = []
+
+    for first, last in merge_ranges(ranges, step):
+        while first <= last:
+            if len(windows) > 0 and first - windows[-1][0] < max_candles * step:
+                window_last = min(last, windows[-1][0] + (max_candles - 1) * step)
+                windows[-1][1] = window_last
+            else:
+                window_last = min(last, first + (max_candles - 1) * step)
+                windows.append([first, window_last])
+            first = window_last + step
+
+    return windows
+
+def build_coverage(historical_data, interval):
+    '''
+    Coverage index of data that is already on disk, e.g. raw data downloaded before
+    coverage indexes existed.
+    '''
+    coverage = empty_coverage(interval)
+    mark_covered(coverage, historical_data['start'].to_numpy())
+    return coverage
+
+def get_coverage(folder, exchange, symbol_exchange, interval):
+    '''
+    The coverage index of a raw dataset, built from the raw data and saved if it does not
+    exist yet. Returns None if there is neither an index nor raw data.
+    '''
+    coverage = load_coverage(folder, exchange, symbol_exchange, interval)
+
+    if coverage is None:
+        raw_path = dataset_path(folder, exchange, symbol_exchange, interval, 'raw')
+        if not dataset_exists(raw_path):
+            return None
+
+        coverage = build_coverage(read_dataset(raw_path, columns=['start']), interval)
+        save_coverage(coverage, folder, exchange, symbol_exchange, interval)
+
+    return coverage
+
+def coverage_report(folder='historical_data', interval='1m'):
+    '''
+    Summary of the coverage of every raw dataset in folder: the time span, the number of
+    candles present, missing and confirmed unavailable, and the number of gaps.
+    '''
+    step = interval_seconds[interval]
+    report = []
+
+    for raw_path in list_datasets(folder, 'raw'):
+        exchange, symbol_exchange, dataset_interval, _ = parse_dataset_path(raw_path)
+        if dataset_interval != interval:
+            continue
+
+        coverage = get_coverage(folder, exchange, symbol_exchange, interval)
+        if len(coverage['covered']) == 0:
+            continue
+
+        missing = missing_ranges(coverage)
+        unavailable = subtract_ranges(missing_ranges(coverage, include_unavailable=True), missing, step)
+
+        report.append({
+            'exchange': exchange,
+            'symbol': symbol_exchange,
+            'first': coverage['covered'][0][0],
+            'last': coverage['covered'][-1][1],
+            'candles': sum((last - first) // step + 1 for first, last in coverage['covered']),
+            'missing': sum((last - first) // step + 1 for first, last in missing),
+            'unavailable': sum((last - first) // step + 1 for first, last in unavailable),
+            'gaps': len(missing)
+        })
+
+    report = pl.DataFrame(report)
+    if report.height > 0:
+        report = report.with_columns(pl.from_epoch('first', time_unit='s'), pl.from_epoch('last', time_unit='s'))
+
+    return report
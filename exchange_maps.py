@@ -56,6 +56,17 @@ interval_map = {
     }
 }
 
+# Length of each interval in seconds
+interval_seconds = {
+    '1m': 60,
+    '5m': 300,
+    '15m': 900,
+    '30m': 1800,
+    '1h': 3600,
+    '6h': 21600,
+    '1d': 86400
+}
+
 symbol_map = {
     'BTCUSD': {
         'binance': 'BTCUSDT',
@@ -0,0 +1,249 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import polars as pl
+from exchange_maps import *
+from storage_functions import *
+from kline_store_functions import *
+
+# Features are columns computed from the stored OHLCV data when they are asked for,
+# instead of being written into every complete dataset. Each is declared once in the
+# features registry as a polars expression, together with the features it is computed
+# from and the number of earlier rows it looks at. compute_features resolves the
+# dependencies of the requested features into one lazy query, and load_features caches
+# the results per dataset until the dataset or the expression changes.
+
+kline_columns = ['start', 'low', 'high', 'open', 'close', 'volume']
+
+features = {}
+
+
+def register_feature(name, expression, depends=(), lookback=0):
+    '''
+    Declare a feature.
+
+    :param name: Name of the feature, and of its column
+    :param expression: Polars expression computing it from the kline columns and the
+        features in depends
+    :param depends: Features the expression uses (kline columns need not be listed)
+    :param lookback: Number of earlier rows the expression reads, e.g. the window of a
+        rolling statistic
+    '''
+    features[name] = {'expression': expression.alias(name), 'depends': list(depends), 'lookback': lookback}
+
+#------------------------------------------------------------
+# Registry
+
+# The columns preprocess_data used to write into every complete dataset
+derived_columns = ['close_pct_change', 'close_diff', 'low_high_diff', 'close_high_diff', 'low_close_diff',
+                   'low_high_diff_pct', 'close_high_diff_pct', 'low_close_diff_pct']
+
+register_feature('close_pct_change', pl.col('close').pct_change(), lookback=1)
+register_feature('close_diff', pl.col('close').diff(), lookback=1)
+register_feature('low_high_diff', pl.col('high') - pl.col('low'))
+register_feature('close_high_diff', pl.col('high') - pl.col('close'))
+register_feature('low_close_diff', pl.col('close') - pl.col('low'))
+register_feature('low_high_diff_pct', pl.col('low_high_diff') / pl.col('close'), depends=['low_high_diff'])
+register_feature('close_high_diff_pct', pl.col('close_high_diff') / pl.col('close'), depends=['close_high_diff'])
+register_feature('low_close_diff_pct', pl.col('low_close_diff') / pl.col('close'), depends=['low_close_diff'])
+
+register_feature('log_return', pl.col('close').log().diff(), lookback=1)
+register_feature('typical_price', (pl.col('high') + pl.col('low') + pl.col('close')) / 3)
+
+# Multi-horizon returns and rolling statistics, in rows of the dataset's interval
+feature_horizons = [5, 15, 60, 240, 1440]
+feature_windows = [60, 1440]
+
+for horizon in feature_horizons:
+    register_feature(f'return_{horizon}', pl.col('close').pct_change(horizon), lookback=horizon)
+
+for window in feature_windows:
+    register_feature(f'volatility_{window}', pl.col('log_return').rolling_std(window), depends=['log_return'], lookback=window)
+    register_feature(f'vwap_{window}', (pl.col('typical_price') * pl.col('volume')).rolling_sum(window) / pl.col('volume').rolling_sum(window),
+                     depends=['typical_price'], lookback=window)
+
+#------------------------------------------------------------
+# Computing features
+
+def feature_levels(names):
+    '''
+    The features needed for names, including their dependencies, grouped into levels
+    that only depend on kline columns and earlier levels.
+    '''
+    levels = {}
+    visiting = set()
+
+    def level(name):
+        if name in kline_columns:
+            return -1
+        if name not in features:
+            raise KeyError(f"Unknown feature: {name}")
+        if name in visiting:
+            raise ValueError(f"Feature {name} depends on itself")
+
+        if name not in levels:
+            visiting.add(name)
+            levels[name] = 1 + max([level(dependency) for dependency in features[name]['depends']], default=-1)
+            visiting.remove(name)
+
+        return levels[name]
+
+    for name in names:
+        level(name)
+
+    return [[name for name, name_level in levels.items() if name_level == i] for i in range(max(levels.values(), default=-1) + 1)]
+
+def feature_lookback(names):
+    '''
+    Number of earlier rows needed to compute names at the first row of a range.
+    '''
+    def lookback(name):
+        if name in kline_columns:
+            return 0
+        return features[name]['lookback'] + max([lookback(dependency) for dependency in features[name]['depends']], default=0)
+
+    return max([lookback(name) for name in names], default=0)
+
+def feature_key(name):
+    '''
+    Hash of the expression of a feature and of everything it depends on, which changes
+    whenever any of them is redeclared differently.
+    '''
+    key = str(features[name]['expression']) + ''.join(feature_key(dependency) for dependency in features[name]['depends'])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def compute_features(historical_data, names):
+    '''
+    Add the features in names to a DataFrame or LazyFrame of klines, as one query plan
+    with a with_columns per dependency level. Dependencies that were not asked for are
+    dropped again.
+    '''
+    keep = historical_data.collect_schema().names() if isinstance(historical_data, pl.LazyFrame) else historical_data.columns
+    keep = keep + [name for name in names if name not in keep]
+
+    for level in feature_levels(names):
+        historical_data = historical_data.with_columns([features[name]['expression'] for name in level])
+
+    return historical_data.select(keep)
+
+#------------------------------------------------------------
+# Feature cache
+
+def feature_cache_path(path):
+    '''
+    The features of a dataset are cached in {folder}/feature_cache/{dataset name}, one
+    Parquet file per feature next to a cache.json recording the dataset fingerprint and
+    the feature_key of every cached feature.
+    '''
+    name = os.path.basename(os.path.normpath(path)).removesuffix('.csv')
+    return os.path.join(os.path.dirname(os.path.normpath(path)), 'feature_cache', name)
+
+def dataset_fingerprint(path):
+    '''
+    Name, size and modification time of every file of a dataset. Every write through
+    storage_functions replaces the files it touches, so any change to the data changes
+    the fingerprint.
+    '''
+    files = [path] if not os.path.isdir(path) else sorted(glob.glob(os.path.join(path, '*.parquet')))
+    return [[os.path.basename(file), os.path.getsize(file), os.stat(file).st_mtime_ns] for file in files]
+
+def update_feature_cache(path, names):
+    '''
+    Compute and cache the features in names that are not cached for the dataset at path
+    yet, or were cached from different data or a different declaration. All of them are
+    computed over the whole dataset in one collect.
+
+    :return: Path of the feature cache
+    '''
+    cache_path = feature_cache_path(path)
+    fingerprint = dataset_fingerprint(path)
+
+    cache = None
+    if os.path.isfile(os.path.join(cache_path, 'cache.json')):
+        with open(os.path.join(cache_path, 'cache.json')) as f:
+            cache = json.load(f)
+
+    if cache is None or cache['fingerprint'] != fingerprint:
+        if os.path.isdir(cache_path):
+            shutil.rmtree(cache_path)
+        os.makedirs(cache_path)
+        cache = {'fingerprint': fingerprint, 'features': {}}
+
+    stale = [name for name in names if name not in kline_columns and cache['features'].get(name) != feature_key(name)]
+    if len(stale) == 0:
+        return cache_path
+
+    computed = compute_features(scan_dataset(path).sort(by='start'), stale).select(['start'] + stale).collect()
+
+    for name in stale:
+        feature_file = os.path.join(cache_path, f'{name}.parquet')
+        computed.select('start', name).write_parquet(feature_file + '.tmp', row_group_size=parquet_row_group_size)
+        os.replace(feature_file + '.tmp', feature_file)
+        cache['features'][name] = feature_key(name)
+
+    with open(os.path.join(cache_path, 'cache.json.tmp'), 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(os.path.join(cache_path, 'cache.json.tmp'), os.path.join(cache_path, 'cache.json'))
+
+    return cache_path
+
+#------------------------------------------------------------
+# Loading features
+
+def load_features(symbol, exchange, names, interval='1m', start=None, end=None,
+                  folder='preprocessed_data', stage='complete', cache=True):
+    '''
+    Load kline columns and features of a symbol on an exchange between start and end.
+
+    :param symbol: The symbol, as in symbol_map
+    :param exchange: The exchange
+    :param names: Kline columns and features to return besides 'start', e.g.
+        ['close', 'return_60', 'volatility_1440']
+    :param interval: The interval of the candles
+    :param start: First candle, as 'yyyy-mm-dd' or a unix timestamp (default: the first stored)
+    :param end: End of the range, exclusive, in the same formats (default: after the last stored)
+    :param folder: Folder of the dataset
+    :param stage: Stage of the dataset
+    :param cache: Read the features from the feature cache, computing and caching them
+        over the whole dataset first where needed. Without it they are computed for the
+        range only, from the rows in it and feature_lookback rows before it.
+    :return: DataFrame sorted by start
+    '''
+    start = None if start is None else to_timestamp(start)
+    end = None if end is None else to_timestamp(end)
+    kline_names = [name for name in names if name in kline_columns and name != 'start']
+    feature_names = [name for name in names if name not in kline_columns]
+
+    if not cache:
+        context_start = None if start is None else start - feature_lookback(feature_names) * interval_seconds[interval]
+        historical_data = compute_features(load_klines(symbol, exchange, interval, context_start, end, folder=folder, stage=stage), feature_names)
+
+        if start is not None:
+            historical_data = historical_data.filter(pl.col('start') >= start)
+        return historical_data.select(['start'] + [name for name in names if name != 'start'])
+
+    path = dataset_path(folder, exchange, symbol_map[symbol][exchange], interval, stage)
+    cache_path = update_feature_cache(path, feature_names)
+
+    historical_data = load_klines(symbol, exchange, interval, start, end, kline_names, folder, stage)
+
+    feature_data = []
+    for name in feature_names:
+        cached_feature = pl.scan_parquet(os.path.join(cache_path, f'{name}.parquet'))
+        if start is not None:
+            cached_feature = cached_feature.filter(pl.col('start') >= start)
+        if end is not None:
+            cached_feature = cached_feature.filter(pl.col('start') < end)
+        feature_data.append(cached_feature)
+
+    # The cache holds the same rows as the dataset, so the features can usually be put 
+    # next to the kline columns as they are, which is much cheaper than a join
+    for cached_feature in pl.collect_all(feature_data):
+        if cached_feature['start'].equals(historical_data['start']):
+            historical_data = historical_data.hstack(cached_feature.drop('start'))
+        else:
+            historical_data = historical_data.join(cached_feature, on='start', how='left')
+
+    return historical_data.select(['start'] + [name for name in names if name != 'start'])
@@ -33,72 +33,22 @@ klines_bitget = get_klines_subset_bitget(symbol='AVAXUSDT', interval=interval, s
 
 #####################################################################
 # Download and save longer periods of data
-# Start dates vary depending on how far back data is available for each exchange
+# Every dataset starts at the first day the exchange has candles for the 
+# symbol, found by find_listing_date (a start date of None) and cached in 
+# historical_data/listing_dates.json. Datasets the exchange has no candles 
+# for are skipped
 
 interval = '1m'
-symbol = 'BTCUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2016-01-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2017-09-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2018-11-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-02-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-08-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2018-08-01', end_date='2024-07-01', exchange='bitget')
+end_date = '2024-07-01'
 
-symbol = 'ETHUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2016-06-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2017-09-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-02-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-02-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-08-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2018-08-01', end_date='2024-07-01', exchange='bitget')
+jobs = [
+    {'symbol': symbol, 'interval': interval, 'start_date': None, 'end_date': end_date, 'exchange': exchange}
+    for symbol in symbol_map.keys()
+    for exchange in symbol_map[symbol].keys()
+]
 
-symbol = 'XRPUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2023-08-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2018-07-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-07-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-02-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-08-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-06-01', end_date='2024-07-01', exchange='bitget')
-
-symbol = 'SOLUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-07-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-09-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-11-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-02-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-06-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-07-01', end_date='2024-07-01', exchange='bitget')
-
-symbol = 'DOGEUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-07-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-08-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-07-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-08-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-08-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-05-01', end_date='2024-07-01', exchange='bitget')
-
-symbol = 'ADAUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-04-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2018-05-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-04-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-03-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-01-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2022-04-01', end_date='2024-07-01', exchange='bitget')
-
-symbol = 'TRXUSD'
-# get_historical_klines(symbol=symbol, interval=interval, start_date='2021-04-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2018-07-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-09-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-02-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-08-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2019-03-01', end_date='2024-07-01', exchange='bitget')
-
-symbol = 'AVAXUSD'
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-10-01', end_date='2024-07-01', exchange='coinbase')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-10-01', end_date='2024-07-01', exchange='binance')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-10-01', end_date='2024-07-01', exchange='bybit')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2020-10-01', end_date='2024-07-01', exchange='okx')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-04-01', end_date='2024-07-01', exchange='digifinex')
-get_historical_klines(symbol=symbol, interval=interval, start_date='2021-12-01', end_date='2024-07-01', exchange='bitget')
+# All datasets are downloaded at once, with each exchange kept within its own rate limit
+get_historical_klines_concurrent(jobs)
 
 
 #####################################################################
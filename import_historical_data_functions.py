@@ -1,44 +1,282 @@
-import jwt
-from cryptography.hazmat.primitives import serialization
 import time
 from datetime import datetime, timezone, timedelta, UTC
-import http.client
 import json
-import pandas as pd
 import os
-from google.cloud import secretmanager
-from binance.client import Client
-from pybit.unified_trading import HTTP
+import io
+import functools
+import hashlib
 import polars as pl
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from exchange_maps import *
-
-OKX_API_URL = "https://www.okx.com"
+from storage_functions import *
+from coverage_functions import *
+
+exchange_api_urls = {
+    'coinbase': 'https://api.coinbase.com',
+    'binance': 'https://api.binance.com',
+    'bybit': 'https://api.bybit.com',
+    'okx': 'https://www.okx.com',
+    'digifinex': 'https://openapi.digifinex.com',
+    'bitget': 'https://api.bitget.com'
+}
 
 #------------------------------------------------------------
 # Load secrets
 
+# Folder checked for local copies of the secrets, one file per secret named after its id
+secrets_dir = os.getenv('crypto_secrets_dir', 'secrets')
+
 def get_gcp_secret(project_id, secret_id):
+    from google.cloud import secretmanager
+
     client = secretmanager.SecretManagerServiceClient()
     response = client.access_secret_version(name=f"projects/{project_id}/secrets/{secret_id}/versions/latest")
     return response.payload.data.decode("UTF-8")
 
-gcp_project_id = os.getenv('gcp_crypto_project')
-binance_api_key = get_gcp_secret(gcp_project_id, 'binance-api-key')
-binance_api_secret = get_gcp_secret(gcp_project_id, 'binance-api-secret')
-coinbase_api_key = get_gcp_secret(gcp_project_id, 'coinbase-api-key')
-coinbase_api_secret = get_gcp_secret(gcp_project_id, 'coinbase-api-secret').replace("\\n", "\n") #needed for Coinbase secrets
+@functools.lru_cache(maxsize=None)
+def get_secret(secret_id):
+    """
+    Load a secret the first time it is needed and keep it for the rest of the process. 
+    An environment variable named after the secret (e.g. COINBASE_API_KEY for 
+    'coinbase-api-key') is used first, then a file named after the secret in 
+    secrets_dir, and only then Google Secret Manager. Nothing is loaded at import 
+    time, so the public market data functions work offline and without GCP credentials.
+    
+    :param secret_id: The id of the secret in Google Secret Manager
+    :return: The secret as a string
+    """
+    env_name = secret_id.upper().replace('-', '_')
+    if os.getenv(env_name) is not None:
+        return os.getenv(env_name)
+
+    secret_file = os.path.join(secrets_dir, secret_id)
+    if os.path.isfile(secret_file):
+        with open(secret_file) as f:
+            return f.read().strip()
+
+    return get_gcp_secret(os.getenv('gcp_crypto_project'), secret_id)
 
 service_name   = "retail_rest_api_proxy"
 
-binance_client = Client(binance_api_key, binance_api_secret)
-bybit_client = HTTP(testnet=False)
+#------------------------------------------------------------
+# Rate limiting
+
+# Minimum number of seconds between two consecutive requests to the same exchange
+exchange_rate_limits = {
+    'coinbase': 0.15,
+    'binance': 0.15,
+    'bybit': 0.15,
+    'okx': 0.22,
+    'digifinex': 0.15,
+    'bitget': 0.07
+}
+
+_rate_limit_locks = {exchange: threading.Lock() for exchange in exchange_rate_limits}
+_next_request_times = {exchange: 0.0 for exchange in exchange_rate_limits}
+
+# Number of requests sent by the current thread, to attribute requests to the job running in it
+_request_counter = threading.local()
+
+def wait_for_rate_limit(exchange):
+    """
+    Block until another request can be sent to the given exchange. Each caller 
+    reserves the next free slot while holding the exchange's lock and then sleeps 
+    outside of it, so any number of threads can share an exchange and requests to 
+    it are still spaced out by exchange_rate_limits[exchange] seconds.
+    
+    :param exchange: The exchange the next request will be sent to
+    """
+    with _rate_limit_locks[exchange]:
+        now = time.monotonic()
+        request_time = max(now, _next_request_times[exchange])
+        _next_request_times[exchange] = request_time + exchange_rate_limits[exchange]
+
+    if request_time > now:
+        time.sleep(request_time - now)
+
+def request_count():
+    """
+    Number of requests exchange_get has sent from the calling thread so far
+    
+    :return: int
+    """
+    return getattr(_request_counter, 'count', 0)
+
+#------------------------------------------------------------
+# HTTP sessions
+
+# Maximum number of kept-alive connections per exchange. Should be at least the number 
+# of threads that can be requesting from the same exchange at once.
+session_pool_size = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(exchange):
+    """
+    Get the shared HTTP session for an exchange, creating it on first use. The session 
+    keeps its connections alive between requests, so the TCP and TLS handshakes are only 
+    paid once per connection rather than once per page. Dropped connections, rate limit 
+    responses (429) and server errors are retried with an exponential backoff.
+    
+    :param exchange: The exchange the session is for
+    :return: requests.Session
+    """
+    with _sessions_lock:
+        if exchange not in _sessions:
+            retry = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=['GET']
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=session_pool_size, max_retries=retry)
+
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[exchange] = session
+
+        return _sessions[exchange]
+
+# Thread pool per exchange that the steps of every download from it are fetched on, as 
+# large as the session's connection pool so that no connection is ever thrown away
+_fetch_executors = {}
+_fetch_executors_lock = threading.Lock()
+
+def get_fetch_executor(exchange):
+    """
+    Get the thread pool that fetches steps from an exchange, creating it on first use. 
+    It is shared by all downloads from the exchange, so at most session_pool_size 
+    requests are in flight to it at once however many datasets are being downloaded.
+    
+    :param exchange: The exchange the pool fetches from
+    :return: ThreadPoolExecutor
+    """
+    with _fetch_executors_lock:
+        if exchange not in _fetch_executors:
+            _fetch_executors[exchange] = ThreadPoolExecutor(max_workers=session_pool_size, thread_name_prefix=f'{exchange}_fetch')
+
+        return _fetch_executors[exchange]
+
+#------------------------------------------------------------
+# Response cache
+
+# What exchange_get does with the on-disk response cache:
+#   'off':          never use the cache
+#   'record':       always send the request, and store the response
+#   'replay':       only serve responses from the cache, never send a request
+#   'read_through': serve cacheable responses from the cache, and send and store the rest
+response_cache_modes = ['off', 'record', 'replay', 'read_through']
+response_cache_mode = os.getenv('crypto_response_cache', 'off')
+response_cache_dir = os.getenv('crypto_response_cache_dir', os.path.join('historical_data', 'response_cache'))
+
+def set_response_cache(mode, cache_dir=None):
+    """
+    Switch the response cache mode, and optionally the directory it is stored in
+    
+    :param mode: One of response_cache_modes
+    :param cache_dir: The directory holding the cached responses (optional)
+    """
+    global response_cache_mode, response_cache_dir
+
+    if mode not in response_cache_modes:
+        raise ValueError(f"Unknown response cache mode: {mode}")
+
+    response_cache_mode = mode
+    response_cache_dir = cache_dir or response_cache_dir
+
+def response_cache_path(exchange, path, params=None):
+    """
+    Path of the cached response to a request. Headers are not part of the key, as they 
+    only carry authentication (e.g. Coinbase's JWT, which changes on every request).
+    
+    :return: Path of the file holding the response body
+    """
+    key = json.dumps([exchange, path, sorted((params or {}).items())], default=str)
+    return os.path.join(response_cache_dir, exchange, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+def _cached_response(cache_path):
+    response = requests.Response()
+    response.status_code = 200
+
+    with open(cache_path, 'rb') as f:
+        response._content = f.read()
+
+    return response
+
+def _store_response(cache_path, response):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmp_path, cache_path)
+
+def exchange_get(exchange, path, params=None, headers=None, cacheable=False):
+    """
+    Send a GET request to an exchange's REST API through its shared session, waiting 
+    for the exchange's rate limit first. Depending on response_cache_mode, the response 
+    is served from and/or stored in the response cache. A response served from the 
+    cache skips both the network and the rate limit.
+    
+    :param exchange: The exchange to send the request to
+    :param path: The request path, e.g. '/api/v5/market/history-index-candles'
+    :param params: Dict of query parameters (optional)
+    :param headers: Dict of extra request headers, or a function returning one that is only 
+        called if the request is actually sent (optional)
+    :param cacheable: Whether the response can never change, e.g. because it only holds 
+        closed candles. Only cacheable responses are served from the cache in 'read_through' 
+        mode, while 'replay' serves any recorded response
+    :return: requests.Response
+    """
+    cache_path = response_cache_path(exchange, path, params) if response_cache_mode != 'off' else None
+
+    if response_cache_mode == 'replay' or (response_cache_mode == 'read_through' and cacheable):
+        if os.path.isfile(cache_path):
+            return _cached_response(cache_path)
+        if response_cache_mode == 'replay':
+            raise FileNotFoundError(f"No cached response for {exchange} {path} {params}")
+
+    if callable(headers):
+        headers = headers()
+
+    wait_for_rate_limit(exchange)
+    _request_counter.count = request_count() + 1
+    response = get_session(exchange).get(exchange_api_urls[exchange] + path, params=params, headers=headers, timeout=30)
+    response.raise_for_status()
+
+    if response_cache_mode == 'record' or (response_cache_mode == 'read_through' and cacheable):
+        _store_response(cache_path, response)
+
+    return response
+
+def candles_closed(end_unix_ms):
+    """
+    Whether every candle that starts before end_unix_ms has closed, so a response holding 
+    them can be cached
+    
+    :param end_unix_ms: Unix timestamp in milliseconds
+    """
+    return end_unix_ms <= (time.time() - 24 * 60 * 60) * 1000
 
 #------------------------------------------------------------
 # Various support functions
 
 def build_jwt_coinbase(service, uri):
+    import jwt
+    from cryptography.hazmat.primitives import serialization
+
+    coinbase_api_key = get_secret('coinbase-api-key')
+    coinbase_api_secret = get_secret('coinbase-api-secret').replace("\\n", "\n") #needed for Coinbase secrets
+
     private_key_bytes = coinbase_api_secret.encode('utf-8')
     private_key = serialization.load_pem_private_key(private_key_bytes, password=None)
     jwt_payload = {
@@ -66,7 +304,7 @@ def list_symbols_binance():
     
     :return: List of symbols
     """
-    exchange_info = binance_client.get_exchange_info()
+    exchange_info = exchange_get('binance', '/api/v3/exchangeInfo').json()
     symbols = [symbol['symbol'] for symbol in exchange_info['symbols']]
     return symbols
 
@@ -81,77 +319,204 @@ def list_symbols_coinbase():
     request_method = "GET"
 
     uri = f"{request_method} {request_host}{request_path}"
-    jwt_token = build_jwt_coinbase(service_name, uri)
 
-    conn = http.client.HTTPSConnection(request_host)
-    payload = ''
-    headers = {
-    'Content-Type': 'application/json',
-    'Authorization': f'Bearer {jwt_token}'
-    }
-    conn.request(request_method, request_path, payload, headers)
-    res = conn.getresponse()
-    data = res.read()
+    # The token is only built if the request is actually sent, so a replayed response 
+    # needs no credentials
+    def headers():
+        return {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {build_jwt_coinbase(service_name, uri)}'
+        }
+    data = exchange_get('coinbase', request_path, headers=headers).json()
 
-    symbols = pl.DataFrame(json.loads(data.decode("utf-8"))['products'])["product_id"].to_list()
+    symbols = pl.DataFrame(data['products'])["product_id"].to_list()
 
     return symbols
 
 #------------------------------------------------------------
 # Download historical klines
 
-def get_klines_subset_binance(symbol, interval, start_date, end_date=None):
+# Maximum number of candles each exchange returns per API call
+exchange_page_limits = {
+    'coinbase': 300,
+    'binance': 1000,
+    'bybit': 1000,
+    'okx': 100,
+    'digifinex': 500,
+    'bitget': 200
+}
+
+# Layout of the rows in each exchange's kline responses: the keys leading from the top of 
+# the response to the list of rows, the name of every field in a row, whether pages list 
+# the newest candle first, and whether timestamps are in milliseconds
+kline_page_formats = {
+    'coinbase': {
+        'rows_path': ["candles"],
+        'columns': ["start", "low", "high", "open", "close", "volume"],
+        'newest_first': True,
+        'start_in_ms': False
+    },
+    'binance': {
+        'rows_path': [],
+        'columns': ["start", "open", "high", "low", "close", "volume", "close_time", "quote_volume",
+                    "trades", "taker_base_volume", "taker_quote_volume", "ignore"],
+        'newest_first': False,
+        'start_in_ms': True
+    },
+    'bybit': {
+        'rows_path': ["result", "list"],
+        'columns': ["start", "open", "high", "low", "close", "volume", "turnover"],
+        'newest_first': True,
+        'start_in_ms': True
+    },
+    'okx': {
+        'rows_path': ["data"],
+        'columns': ["start", "open", "high", "low", "close", "confirm"],
+        'newest_first': True,
+        'start_in_ms': True
+    },
+    'digifinex': {
+        'rows_path': ["data"],
+        'columns': ["start", "volume", "close", "high", "low", "open"],
+        'newest_first': False,
+        'start_in_ms': False
+    },
+    'bitget': {
+        'rows_path': ["data"],
+        'columns': ["start", "open", "high", "low", "close", "volume", "volume2", "volume3"],
+        'newest_first': False,
+        'start_in_ms': True
+    }
+}
+
+def to_unix(date):
+    """
+    Convert a fetcher bound to a unix timestamp in seconds
+
+    :param date: A date in 'yyyy-mm-dd' format (midnight UTC), or a unix timestamp in seconds
+    :return: Unix timestamp in seconds
+    """
+    if isinstance(date, str):
+        return int(datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+    return int(date)
+
+def klines_from_payloads(payloads, exchange):
+    """
+    Build one typed DataFrame straight out of the raw bytes of the responses of an 
+    exchange's kline endpoint, without creating a Python object per candle or field. 
+    
+    Every exchange but Coinbase returns the candles as one array of flat arrays of 
+    numbers (quoted or not), so that array is cut out of each response, the brackets 
+    between rows are turned into line breaks and the quotes are dropped, which leaves 
+    CSV text that Polars parses straight into typed columns. Coinbase returns objects, 
+    which are parsed by Polars as JSON with a fixed schema.
+    
+    :param payloads: List of response bodies (bytes), one per page
+    :param exchange: The exchange the payloads came from
+    :return: DataFrame with the columns start, low, high, open, close, volume
+    """
+    page_format = kline_page_formats[exchange]
+    columns = page_format['columns']
+
+    if exchange == 'coinbase':
+        rows_key = page_format['rows_path'][0]
+        schema = {rows_key: pl.List(pl.Struct({column: pl.String for column in columns}))}
+
+        # JSON strings cannot hold raw line breaks, so dropping them turns every payload 
+        # into exactly one line of NDJSON
+        payloads = [payload.replace(b'\n', b' ').replace(b'\r', b' ') for payload in payloads]
+        df_pages = pl.read_ndjson(io.BytesIO(b'\n'.join(payloads)), schema=schema) if len(payloads) > 0 \
+            else pl.DataFrame(schema=schema)
+
+        df_klines = df_pages.select(pl.col(rows_key).list.reverse().alias("row")).explode("row").drop_nulls("row").unnest("row")
+
+        return _typed_klines(df_klines, page_format)
+
+    pages = []
+    for payload in payloads:
+        payload = payload.translate(None, b'" \n\r\t')
+        first = payload.find(b'[[')
+        # An empty page has no array of rows
+        if first != -1:
+            pages.append(payload[first + 2:payload.find(b']]', first)])
+
+    schema = {column: pl.Int64 if column == "start" else pl.Float64 for column in columns}
+    selected = [columns.index(column) for column in ["start", "low", "high", "open", "close", "volume"] if column in columns]
+
+    if len(pages) == 0:
+        return _typed_klines(pl.DataFrame(schema=schema), page_format)
+
+    df_klines = pl.read_csv(b'\n'.join(pages).replace(b'],[', b'\n'), has_header=False, schema=schema, columns=selected)
+
+    if page_format['newest_first']:
+        rows_per_page = np.array([page.count(b'],[') + 1 for page in pages])
+        page_ends = np.cumsum(rows_per_page)
+        page_starts = page_ends - rows_per_page
+        df_klines = df_klines[np.repeat(page_starts + page_ends - 1, rows_per_page) - np.arange(page_ends[-1])]
+
+    return _typed_klines(df_klines, page_format)
+
+def _typed_klines(df_klines, page_format):
+    # OKX index candles have no volume
+    if 'volume' not in df_klines.columns:
+        df_klines = df_klines.with_columns(pl.lit(None).alias('volume'))
+
+    start = pl.col("start").cast(pl.Int64)
+    if page_format['start_in_ms']:
+        start = start // 1000
+
+    df_klines = df_klines.select([
+        start.alias("start"),
+        pl.col("low").cast(pl.Float64),
+        pl.col("high").cast(pl.Float64),
+        pl.col("open").cast(pl.Float64),
+        pl.col("close").cast(pl.Float64),
+        pl.col("volume").cast(pl.Float64)
+    ])
+
+    return df_klines
+
+def get_klines_subset_binance(symbol, interval, start_date, end_date):
     """
-    Get historical kline data from Binance. This one doesn't seem to have a 
-    limit on the number of candles you can request.
+    Get historical kline data from Binance. At most only 1000 candles can 
+    be retrieved per API call
     
     :param symbol: The trading pair symbol
     :param interval: The interval for klines
-    :param start_date: The start date in 'yyyy-mm-dd' format
-    :param end_date: The end date in 'yyyy-mm-dd' format (optional)
+    :param start_date: The start date in 'yyyy-mm-dd' format, or a unix timestamp in seconds
+    :param end_date: The end date (exclusive) in 'yyyy-mm-dd' format, or a unix timestamp in seconds
     :return: List of klines
     """
+    start_unix_ms = to_unix(start_date)*1000
+    end_unix_ms = to_unix(end_date)*1000 - 60000
     interval_binance = interval_map[interval]['binance']
-    klines = binance_client.get_historical_klines(symbol, interval_binance, start_date, end_date)
-
-    column_names = [
-        "Open time",
-        "Open",
-        "High",
-        "Low",
-        "Close",
-        "Volume",
-        "Close time",
-        "Quote asset volume",
-        "Number of trades",
-        "Taker buy base asset volume",
-        "Taker buy quote asset volume",
-        "ignore"
-        ]
-
-    # Create the DataFrame
-    df_klines = pl.DataFrame(klines, schema=column_names) \
-        .select(["Open time", "Low", "High", "Open", "Close", "Volume"]) \
-        .with_columns([
-            pl.col("Open").cast(pl.Float64),
-            pl.col("High").cast(pl.Float64),
-            pl.col("Low").cast(pl.Float64),
-            pl.col("Close").cast(pl.Float64),
-            pl.col("Volume").cast(pl.Float64)
-        ]) \
-        .rename({
-            "Open time": "start",
-            "Open": "open",
-            "High": "high",
-            "Low": "low",
-            "Close": "close",
-            "Volume": "volume"
-        }) \
-        .with_columns((pl.col("start") / 1000).alias("start").cast(pl.Int64))
-    
-    df_klines = df_klines.slice(0, df_klines.shape[0] - 1)
 
-    return df_klines
+    sub_start_unix_ms = start_unix_ms
+
+    params = {
+        'symbol': symbol,
+        'interval': interval_binance,
+        'limit': 1000
+    }
+
+    pages = []
+
+    while sub_start_unix_ms <= end_unix_ms:
+        params['startTime'] = sub_start_unix_ms
+        params['endTime'] = end_unix_ms
+
+        # Each page is decoded as it arrives, since the next request starts after its last candle
+        page = klines_from_payloads([exchange_get('binance', '/api/v3/klines', params=params, cacheable=candles_closed(end_unix_ms + 60000)).content], 'binance')
+
+        # Binance returns the first candles at or after startTime, so an empty page 
+        # means there is nothing left in the range
+        if page.height == 0:
+            break
+
+        pages.append(page)
+        sub_start_unix_ms = (page['start'][-1] + 60) * 1000
+
+    return pl.concat(pages) if len(pages) > 0 else klines_from_payloads([], 'binance')
 
 def get_klines_subset_coinbase(symbol, interval, start_date, end_date):
     """
@@ -160,57 +525,39 @@ def get_klines_subset_coinbase(symbol, interval, start_date, end_date):
     
     :param symbol: The trading pair symbol
     :param interval: The interval for klines
-    :param start_date: The start date in 'yyyy-mm-dd' format
-    :param end_date: The end date in 'yyyy-mm-dd' format
+    :param start_date: The start date in 'yyyy-mm-dd' format, or a unix timestamp in seconds
+    :param end_date: The end date (exclusive) in 'yyyy-mm-dd' format, or a unix timestamp in seconds
     :return: List of klines
     """
-    start_unix = int(datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
-    end_unix = int(datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()) - 60
+    start_unix = to_unix(start_date)
+    end_unix = to_unix(end_date) - 60
     interval_coinbase = interval_map[interval]['coinbase']
 
-    request_host = "api.coinbase.com"
-    request_path_uri = f"/api/v3/brokerage/market/products/{symbol}/candles"
-    request_method = "GET"
+    request_path = f"/api/v3/brokerage/market/products/{symbol}/candles"
 
-    # uri = f"{request_method} {request_host}{request_path_uri}"
-    # jwt_token = build_jwt_coinbase(service_name, uri)
-
-    conn = http.client.HTTPSConnection(request_host)
-    payload = ''
     headers = {
-    'Content-Type': 'application/json'#,
-    # 'Authorization': f'Bearer {jwt_token}'
+    'Content-Type': 'application/json'
+    }
+
+    params = {
+        'granularity': interval_coinbase
     }
 
     sub_start_unix = start_unix
 
-    df_klines = pl.DataFrame()
+    pages = []
 
     while sub_start_unix <= end_unix:
         sub_end_unix = min(sub_start_unix + 60*299, end_unix)
-        request_path = request_path_uri + f"?start={sub_start_unix}&end={sub_end_unix}&granularity={interval_coinbase}"
-        conn.request(request_method, request_path, payload, headers)
-        res = conn.getresponse()
-        data = json.loads(res.read().decode("utf-8"))['candles']
-
-        if len(data) > 0:
-            df_klines = df_klines.vstack(pl.DataFrame(data) \
-                .reverse()\
-                .with_columns([
-                    pl.col("open").cast(pl.Float64),
-                    pl.col("high").cast(pl.Float64),
-                    pl.col("low").cast(pl.Float64),
-                    pl.col("close").cast(pl.Float64),
-                    pl.col("volume").cast(pl.Float64),
-                    pl.col("start").cast(pl.Int64)
-                ]))
+        params['start'] = sub_start_unix
+        params['end'] = sub_end_unix
+
+        cacheable = candles_closed((sub_end_unix + 60) * 1000)
+        pages.append(exchange_get('coinbase', request_path, params=params, headers=headers, cacheable=cacheable).content)
         
         sub_start_unix = sub_end_unix + 60
 
-        if sub_start_unix <= end_unix:
-            time.sleep(0.15)
-
-    return df_klines
+    return klines_from_payloads(pages, 'coinbase')
 
 def get_klines_subset_bybit(symbol, interval, start_date, end_date, category='linear'):
     """
@@ -219,63 +566,38 @@ def get_klines_subset_bybit(symbol, interval, start_date, end_date, category='li
     
     :param symbol: The trading pair symbol
     :param interval: The interval for klines
-    :param start_date: The start date in 'yyyy-mm-dd' format
-    :param end_date: The end date in 'yyyy-mm-dd' format
+    :param start_date: The start date in 'yyyy-mm-dd' format, or a unix timestamp in seconds
+    :param end_date: The end date (exclusive) in 'yyyy-mm-dd' format, or a unix timestamp in seconds
     :param category: The type of product (must be correct for the symbol)
     :return: List of klines
     """
-    start_unix_ms = int(datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()*1000)
-    end_unix_ms = int(datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()*1000) - 60000
+    start_unix_ms = to_unix(start_date)*1000
+    end_unix_ms = to_unix(end_date)*1000 - 60000
     interval_bybit = interval_map[interval]['bybit']
 
     sub_start_unix_ms = start_unix_ms
 
-    column_names = [
-        "start",
-        "open",
-        "high",
-        "low",
-        "close",
-        "volume",
-        "turnover"
-        ]
+    pages = []
 
-    df_klines = pl.DataFrame()
+    params = {
+        'category': category,
+        'symbol': symbol,
+        'interval': interval_bybit,
+        'limit': 1000
+    }
 
     while sub_start_unix_ms <= end_unix_ms:
         sub_end_unix_ms = min(sub_start_unix_ms + 60000*999, end_unix_ms)
-        
-        response = bybit_client.get_kline(
-            category=category,
-            symbol=symbol,
-            interval=interval_bybit,
-            start=sub_start_unix_ms,
-            end=sub_end_unix_ms,
-            limit=1000
-        )
-
-        data = response['result']['list']
-
-        if len(data) > 0:
-            df_klines = df_klines.vstack(pl.DataFrame(data, schema=column_names) \
-                .select(["start", "low", "high", "open", "close", "volume"])\
-                .reverse()\
-                .with_columns([
-                    pl.col("open").cast(pl.Float64),
-                    pl.col("high").cast(pl.Float64),
-                    pl.col("low").cast(pl.Float64),
-                    pl.col("close").cast(pl.Float64),
-                    pl.col("volume").cast(pl.Float64),
-                    pl.col("start").cast(pl.Int64)
-                ])\
-                .with_columns((pl.col("start") / 1000).alias("start").cast(pl.Int64)))
+
+        params['start'] = sub_start_unix_ms
+        params['end'] = sub_end_unix_ms
+
+        cacheable = candles_closed(sub_end_unix_ms + 60000)
+        pages.append(exchange_get('bybit', '/v5/market/kline', params=params, cacheable=cacheable).content)
         
         sub_start_unix_ms = sub_end_unix_ms + 60000
 
-        if sub_start_unix_ms <= end_unix_ms:
-            time.sleep(0.15)
-
-    return df_klines
+    return klines_from_payloads(pages, 'bybit')
 
 def get_klines_subset_okx(symbol, interval, start_date, end_date):
     """
@@ -284,26 +606,17 @@ def get_klines_subset_okx(symbol, interval, start_date, end_date):
     
     :param symbol: The trading pair symbol
     :param interval: The interval for klines
-    :param start_date: The start date in 'yyyy-mm-dd' format
-    :param end_date: The end date in 'yyyy-mm-dd' format
+    :param start_date: The start date in 'yyyy-mm-dd' format, or a unix timestamp in seconds
+    :param end_date: The end date (exclusive) in 'yyyy-mm-dd' format, or a unix timestamp in seconds
     :return: List of klines
     """
-    start_unix_ms = int(datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()*1000) - 60000
-    end_unix_ms = int(datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()*1000)
+    start_unix_ms = to_unix(start_date)*1000 - 60000
+    end_unix_ms = to_unix(end_date)*1000
     interval_okx = interval_map[interval]['okx']
 
     sub_start_unix_ms = start_unix_ms
 
-    column_names = [
-        "start",
-        "open",
-        "high",
-        "low",
-        "close",
-        "confirm"
-        ]
-
-    df_klines = pl.DataFrame()
+    pages = []
 
     params = {
         'instId': symbol,
@@ -315,30 +628,13 @@ def get_klines_subset_okx(symbol, interval, start_date, end_date):
 
         params['before'] = str(sub_start_unix_ms)
         params['after'] = str(sub_end_unix_ms)
-        
-        response = requests.get(f"{OKX_API_URL}/api/v5/market/history-index-candles", params=params)
-
-        data = response.json()['data']
-
-        if len(data) > 0:
-            df_klines = df_klines.vstack(pl.DataFrame(data, schema=column_names) \
-                .select(["start", "low", "high", "open", "close"])\
-                .reverse()\
-                .with_columns([
-                    pl.col("open").cast(pl.Float64),
-                    pl.col("high").cast(pl.Float64),
-                    pl.col("low").cast(pl.Float64),
-                    pl.col("close").cast(pl.Float64),
-                    pl.col("start").cast(pl.Int64)
-                ])\
-                .with_columns((pl.col("start") / 1000).alias("start").cast(pl.Int64)))
+
+        cacheable = candles_closed(sub_end_unix_ms)
+        pages.append(exchange_get('okx', '/api/v5/market/history-index-candles', params=params, cacheable=cacheable).content)
         
         sub_start_unix_ms += 60000 * 100
 
-        if sub_start_unix_ms <= end_unix_ms:
-            time.sleep(0.22)
-
-    return df_klines
+    return klines_from_payloads(pages, 'okx')
 
 def get_klines_subset_digifinex(symbol, interval, start_date, end_date):
     """
@@ -347,26 +643,17 @@ def get_klines_subset_digifinex(symbol, interval, start_date, end_date):
     
     :param symbol: The trading pair symbol
     :param interval: The interval for klines
-    :param start_date: The start date in 'yyyy-mm-dd' format
-    :param end_date: The end date in 'yyyy-mm-dd' format
+    :param start_date: The start date in 'yyyy-mm-dd' format, or a unix timestamp in seconds
+    :param end_date: The end date (exclusive) in 'yyyy-mm-dd' format, or a unix timestamp in seconds
     :return: List of klines
     """
-    start_unix = int(datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
-    end_unix = int(datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()) - 60
+    start_unix = to_unix(start_date)
+    end_unix = to_unix(end_date) - 60
     interval_digifinex = interval_map[interval]['digifinex']
 
     sub_start_unix = start_unix
 
-    column_names = [
-        "start",
-        "volume",
-        "close",
-        "high",
-        "low",
-        "open"
-        ]
-
-    df_klines = pl.DataFrame()
+    pages = []
 
     params = {
         'symbol': symbol,
@@ -378,59 +665,32 @@ def get_klines_subset_digifinex(symbol, interval, start_date, end_date):
 
         params['start_time'] = sub_start_unix
         params['end_time'] = sub_end_unix
-        
-        response = requests.get('https://openapi.digifinex.com/v3/kline', params=params)
-
-        data = response.json()['data']
-
-        if len(data) > 0:
-            df_klines = df_klines.vstack(pl.DataFrame(data, schema=column_names) \
-                .select(["start", "low", "high", "open", "close", "volume"])\
-                .with_columns([
-                    pl.col("open").cast(pl.Float64),
-                    pl.col("high").cast(pl.Float64),
-                    pl.col("low").cast(pl.Float64),
-                    pl.col("close").cast(pl.Float64),
-                    pl.col("volume").cast(pl.Float64),
-                    pl.col("start").cast(pl.Int64)
-                ]))
+
+        cacheable = candles_closed((sub_end_unix + 60) * 1000)
+        pages.append(exchange_get('digifinex', '/v3/kline', params=params, cacheable=cacheable).content)
         
         sub_start_unix += 60 * 500
 
-        if sub_start_unix <= end_unix:
-            time.sleep(0.15)
-
-    return df_klines
+    return klines_from_payloads(pages, 'digifinex')
 
 def get_klines_subset_bitget(symbol, interval, start_date, end_date):
     """
-    Get historical kline data from Bitget. At most only 100 candles can 
+    Get historical kline data from Bitget. At most only 200 candles can 
     be retrieved per API call
     
     :param symbol: The trading pair symbol
     :param interval: The interval for klines
-    :param start_date: The start date in 'yyyy-mm-dd' format
-    :param end_date: The end date in 'yyyy-mm-dd' format
+    :param start_date: The start date in 'yyyy-mm-dd' format, or a unix timestamp in seconds
+    :param end_date: The end date (exclusive) in 'yyyy-mm-dd' format, or a unix timestamp in seconds
     :return: List of klines
     """
-    start_unix_ms = int(datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()*1000)
-    end_unix_ms = int(datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()*1000)
+    start_unix_ms = to_unix(start_date)*1000
+    end_unix_ms = to_unix(end_date)*1000
     interval_bitget = interval_map[interval]['bitget']
 
     sub_start_unix_ms = start_unix_ms
 
-    column_names = [
-        "start",
-        "open",
-        "high",
-        "low",
-        "close",
-        "volume",
-        "volume2",
-        "volume3"
-        ]
-
-    df_klines = pl.DataFrame()
+    pages = []
 
     params = {
         'symbol': symbol,
@@ -442,30 +702,13 @@ def get_klines_subset_bitget(symbol, interval, start_date, end_date):
 
         params['endTime'] = str(sub_end_unix_ms)
         params['limit'] = int((sub_end_unix_ms - sub_start_unix_ms) / 60000)
-        
-        response = requests.get("https://api.bitget.com/api/v2/spot/market/history-candles", params=params)
-
-        data = response.json()['data']
-
-        if len(data) > 0:
-            df_klines = df_klines.vstack(pl.DataFrame(data, schema=column_names) \
-                .select(["start", "low", "high", "open", "close", "volume"])\
-                .with_columns([
-                    pl.col("open").cast(pl.Float64),
-                    pl.col("high").cast(pl.Float64),
-                    pl.col("low").cast(pl.Float64),
-                    pl.col("close").cast(pl.Float64),
-                    pl.col("volume").cast(pl.Float64),
-                    pl.col("start").cast(pl.Int64)
-                ])\
-                .with_columns((pl.col("start") / 1000).alias("start").cast(pl.Int64)))
+
+        cacheable = candles_closed(sub_end_unix_ms)
+        pages.append(exchange_get('bitget', '/api/v2/spot/market/history-candles', params=params, cacheable=cacheable).content)
         
         sub_start_unix_ms += 60000 * 200
 
-        if sub_start_unix_ms <= end_unix_ms:
-            time.sleep(0.07)
-
-    return df_klines
+    return klines_from_payloads(pages, 'bitget')
 
 def get_klines_subset(symbol, interval, start_date, end_date, exchange):
     if exchange == 'coinbase':
@@ -482,58 +725,305 @@ def get_klines_subset(symbol, interval, start_date, end_date, exchange):
         df_klines = get_klines_subset_bitget(symbol, interval, start_date, end_date)
     return df_klines
 
-def get_historical_klines(symbol, interval, start_date, end_date, exchange, step_size=5):
+#------------------------------------------------------------
+# Listing dates
+
+# Cache of the dates found by find_listing_date, keyed by exchange, symbol and interval
+listing_dates_file = os.path.join('historical_data', 'listing_dates.json')
+
+_listing_dates_lock = threading.Lock()
+
+def load_listing_dates():
+    if not os.path.isfile(listing_dates_file):
+        return {}
+
+    with open(listing_dates_file) as f:
+        return json.load(f)
+
+def _has_klines(symbol_exchange, interval, start_unix, exchange):
+    # A single page of candles from start_unix on
+    end_unix = start_unix + exchange_page_limits[exchange] * interval_seconds[interval]
+    return len(get_klines_subset(symbol_exchange, interval, start_unix, end_unix, exchange)) > 0
+
+def find_listing_date(symbol, interval, exchange, earliest_date='2015-01-01', refresh=False):
+    """
+    Find the first day an exchange has candles for a symbol, by binary searching over 
+    days with single-page probes at midnight (about a dozen requests for ten years). 
+    The page at midnight of the listing day itself is usually empty, so the day before 
+    the first day with a non-empty probe is then fetched in full. Found dates are cached 
+    in listing_dates_file, so each (exchange, symbol, interval) is only searched once.
+
+    Assumes that once candles start, every later midnight page has some. A symbol that 
+    was delisted and relisted is found at its latest listing.
+    
+    :param symbol: The trading pair symbol, as in symbol_map
+    :param interval: The interval for klines
+    :param exchange: The exchange to search
+    :param earliest_date: The earliest date considered in 'yyyy-mm-dd' format
+    :param refresh: Search again even if the date is cached
+    :return: The listing date in 'yyyy-mm-dd' format, or None if the exchange has no candles
+    """
     symbol_exchange = symbol_map[symbol][exchange]
-    partial_csv_name = f'historical_data/{exchange}_{symbol_exchange}_{interval}_data_partial.csv'
-    complete_csv_name = f'historical_data/{exchange}_{symbol_exchange}_{interval}_data_raw.csv'
+    key = f"{exchange}_{symbol_exchange}_{interval}"
+
+    if not refresh:
+        with _listing_dates_lock:
+            listing_date = load_listing_dates().get(key)
+        if listing_date is not None:
+            return listing_date
+
+    day = 24 * 60 * 60
+    low = to_unix(earliest_date)
+    high = int(time.time()) // day * day - day
+
+    if _has_klines(symbol_exchange, interval, low, exchange):
+        first_day = low
+    elif not _has_klines(symbol_exchange, interval, high, exchange):
+        print(f"{exchange} | {symbol} {interval}: No candles found")
+        return None
+    else:
+        # low never has candles, high always does
+        while high - low > day:
+            middle = low + (high - low) // (2 * day) * day
+            if _has_klines(symbol_exchange, interval, middle, exchange):
+                high = middle
+            else:
+                low = middle
 
-    start_datetime = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        first_day = high
+        if len(get_klines_subset(symbol_exchange, interval, low, high, exchange)) > 0:
+            first_day = low
+
+    listing_date = datetime.fromtimestamp(first_day, UTC).strftime('%Y-%m-%d')
+    print(f"{exchange} | {symbol} {interval}: Listing date {listing_date}")
+
+    with _listing_dates_lock:
+        listing_dates = load_listing_dates()
+        listing_dates[key] = listing_date
+
+        os.makedirs(os.path.dirname(listing_dates_file), exist_ok=True)
+        with open(listing_dates_file + '.tmp', 'w') as f:
+            json.dump(listing_dates, f, indent=4, sort_keys=True)
+        os.replace(listing_dates_file + '.tmp', listing_dates_file)
+
+    return listing_date
+
+#------------------------------------------------------------
+# Download and save historical data
 
-    if os.path.isfile(partial_csv_name):
-        last_timestamp = pl.read_csv(partial_csv_name, columns=['start'])['start'][-1]
+# Maximum number of fetched steps waiting to be written by get_historical_klines
+write_queue_size = 2
 
-        sub_start_datetime = datetime.fromtimestamp(last_timestamp, UTC) + timedelta(days=1)
-        print(f"Resuming from: {sub_start_datetime.strftime('%Y-%m-%d')}")
+def _fetch_step(symbol_exchange, interval, sub_start_unix, sub_end_unix, exchange):
+    # Runs on the exchange's fetch pool. The requests it sent are returned, so that they 
+    # can be counted by request_count of the thread that wanted the step.
+    requests_before = request_count()
+    sub_df_klines = get_klines_subset(symbol_exchange, interval, sub_start_unix, sub_end_unix, exchange)
+    return sub_df_klines, request_count() - requests_before
+
+def checkpoint_path(folder, exchange, symbol_exchange, interval):
+    return os.path.join(folder, f'{exchange}_{symbol_exchange}_{interval}_checkpoint.json')
+
+def load_checkpoint(folder, exchange, symbol_exchange, interval):
+    path = checkpoint_path(folder, exchange, symbol_exchange, interval)
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(checkpoint, folder, exchange, symbol_exchange, interval):
+    path = checkpoint_path(folder, exchange, symbol_exchange, interval)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+def get_historical_klines(symbol, interval, start_date=None, end_date=None, exchange=None, step_size=5, concurrent_steps=4):
+    '''
+    Downloads klines from start_date up to (not including) end_date in steps of step_size 
+    days, appending every step to the partial dataset. A start_date of None starts from 
+    the date find_listing_date discovers, and an end_date of None ends at midnight UTC 
+    today. The exchange is required, it only has a default to keep the order of the 
+    arguments.
+
+    Up to concurrent_steps consecutive steps are fetched at the same time on the 
+    exchange's fetch pool (see get_fetch_executor), with every request still waiting for 
+    the exchange's rate limit, so a long history is not bound by the latency of one 
+    request after the other. The steps are written in order by a writer thread, fed 
+    through a queue of at most write_queue_size steps. After every write a checkpoint 
+    records the end of the range persisted so far (and for CSV the size of the file), so 
+    an interrupted download resumes exactly where it stopped, and anything written after 
+    the last checkpoint is cut off first.
+    '''
+    if exchange is None:
+        raise TypeError("get_historical_klines() missing required argument: 'exchange'")
+    symbol_exchange = symbol_map[symbol][exchange]
+
+    if start_date is None:
+        start_date = find_listing_date(symbol, interval, exchange)
+        if start_date is None:
+            return
+    if end_date is None:
+        end_date = datetime.now(UTC).strftime('%Y-%m-%d')
+    partial_path = dataset_path('historical_data', exchange, symbol_exchange, interval, 'partial')
+    raw_path = dataset_path('historical_data', exchange, symbol_exchange, interval, 'raw')
+
+    start_unix = to_unix(start_date)
+    end_unix = to_unix(end_date)
+    step_seconds = step_size * 24 * 60 * 60
+
+    checkpoint = load_checkpoint('historical_data', exchange, symbol_exchange, interval) if dataset_exists(partial_path) else None
+
+    if checkpoint is not None:
+        if partial_path.endswith('.csv'):
+            os.truncate(partial_path, checkpoint['csv_bytes'])
+
+        sub_start_unix = checkpoint['fetched_until']
+
+        # The partial index is saved after every step, so resuming does not need to read 
+        # the partial dataset. Whatever it records past the checkpoint was cut off above 
+        # or is fetched again.
+        coverage = load_coverage('historical_data', exchange, symbol_exchange, interval, 'partial')
+        if coverage is None:
+            coverage = build_coverage(read_dataset(partial_path, columns=['start']), interval)
+        clip_coverage(coverage, checkpoint['fetched_until'])
+        print(f"{exchange} | {symbol} {interval}: Resuming from: {datetime.fromtimestamp(sub_start_unix, UTC)}")
+    elif dataset_exists(partial_path) and len(partial_starts := read_dataset(partial_path, columns=['start'])['start']) > 0:
+        # Partial dataset written before checkpoints existed
+        checkpoint = {'last_start': int(partial_starts.max())}
+        sub_start_unix = checkpoint['last_start'] + interval_seconds[interval]
+        coverage = build_coverage(partial_starts.to_frame(), interval)
+        print(f"{exchange} | {symbol} {interval}: Resuming from: {datetime.fromtimestamp(sub_start_unix, UTC)}")
     else:
-        pl.DataFrame(schema=["start", "low", "high", "open", "close", "volume"])\
-            .write_csv(partial_csv_name)
+        write_dataset(pl.DataFrame(schema=["start", "low", "high", "open", "close", "volume"]), partial_path)
         
-        sub_start_datetime = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
-        print(f"Starting from: {sub_start_datetime}")
-    
-    end_datetime = datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        checkpoint = {'last_start': None}
+        sub_start_unix = start_unix
+        coverage = empty_coverage(interval)
+        print(f"{exchange} | {symbol} {interval}: Starting from: {datetime.fromtimestamp(sub_start_unix, UTC)}")
 
-    total_steps = int(np.ceil((end_datetime - start_datetime) / timedelta(days=step_size)))
-    total_steps_this_run = total_steps - int(np.ceil((sub_start_datetime - start_datetime) / timedelta(days=step_size)) - 1)
+    total_steps = int(np.ceil((end_unix - start_unix) / step_seconds))
+    total_steps_this_run = total_steps - int(np.ceil((sub_start_unix - start_unix) / step_seconds)) + 1
     completed_steps_this_run = 0
 
     start_time = time.time()
 
-    with open(partial_csv_name, 'a') as f:
-        while sub_start_datetime < end_datetime:
-            sub_start_date = sub_start_datetime.strftime('%Y-%m-%d')
-            sub_end_datetime = min(sub_start_datetime + timedelta(days=step_size), end_datetime)
-            sub_end_date = sub_end_datetime.strftime('%Y-%m-%d')
+    write_queue = queue.Queue(maxsize=write_queue_size)
+    write_errors = []
 
-            sub_df_klines = get_klines_subset(symbol_exchange, interval, sub_start_date, sub_end_date, exchange)
+    def write_steps():
+        nonlocal completed_steps_this_run
 
-            sub_df_klines.write_csv(f, include_header=False)
+        while (step := write_queue.get()) is not None:
+            # After a failed write the queue is still drained, so the fetching side never blocks
+            if len(write_errors) > 0:
+                continue
 
-            completed_steps = int(np.ceil((sub_end_datetime - start_datetime) / timedelta(days=step_size)))
+            sub_df_klines, sub_end_unix = step
+
+            try:
+                append_dataset(sub_df_klines, partial_path)
+
+                # Candles the exchange did not return are left uncovered rather than marked as 
+                # unavailable, since they may be missing because of a transient error. The 
+                # partial dataset has its own index until it becomes the raw dataset.
+                mark_covered(coverage, sub_df_klines['start'].to_numpy())
+                save_coverage(coverage, 'historical_data', exchange, symbol_exchange, interval, 'partial')
+
+                if sub_df_klines.height > 0:
+                    checkpoint['last_start'] = int(sub_df_klines['start'].max())
+                checkpoint['fetched_until'] = sub_end_unix
+                if partial_path.endswith('.csv'):
+                    checkpoint['csv_bytes'] = os.path.getsize(partial_path)
+                save_checkpoint(checkpoint, 'historical_data', exchange, symbol_exchange, interval)
+            except Exception as e:
+                write_errors.append(e)
+                continue
+
+            completed_steps = int(np.ceil((sub_end_unix - start_unix) / step_seconds))
             completed_steps_this_run += 1
 
             end_time = time.time()
 
-            print(f"Step {completed_steps}/{total_steps} complete ({round(100*completed_steps/total_steps, 1)}%)." +
+            print(f"{exchange} | {symbol} {interval}: Step {completed_steps}/{total_steps} complete ({round(100*completed_steps/total_steps, 1)}%)." +
                   f" Estimated time remaining: {round((end_time - start_time) * ((total_steps_this_run / completed_steps_this_run) - 1), 1)} s")
-            
-            sub_start_datetime = sub_end_datetime
+
+    writer = threading.Thread(target=write_steps)
+    writer.start()
+
+    fetch_executor = get_fetch_executor(exchange)
+    fetching = collections.deque()
+
+    try:
+        while (sub_start_unix < end_unix or len(fetching) > 0) and len(write_errors) == 0:
+            while sub_start_unix < end_unix and len(fetching) < concurrent_steps:
+                sub_end_unix = min(sub_start_unix + step_seconds, end_unix)
+                fetching.append((fetch_executor.submit(_fetch_step, symbol_exchange, interval, sub_start_unix, sub_end_unix, exchange), sub_end_unix))
+                sub_start_unix = sub_end_unix
+
+            future, sub_end_unix = fetching.popleft()
+            sub_df_klines, n_requests = future.result()
+            _request_counter.count = request_count() + n_requests
+
+            write_queue.put((sub_df_klines, sub_end_unix))
+    finally:
+        for future, _ in fetching:
+            future.cancel()
+        write_queue.put(None)
+        writer.join()
+
+    if len(write_errors) > 0:
+        raise write_errors[0]
     
-    if not os.path.isfile(complete_csv_name):
-        os.rename(partial_csv_name, complete_csv_name)
+    if not dataset_exists(raw_path):
+        merge_partial_coverage('historical_data', exchange, symbol_exchange, interval)
+        move_dataset(partial_path, raw_path)
+        remove_dataset(checkpoint_path('historical_data', exchange, symbol_exchange, interval))
         print(f"Data import complete: {exchange} | {symbol} {interval} from {start_date} to {end_date}")
     else:
-        print("Data import complete, but raw data file already exists. Please overwrite manually")
+        # The coverage of the new rows stays in the partial index, the raw index only 
+        # describes the raw dataset
+        print(f"Data import complete, but raw data file {raw_path} already exists. Please overwrite manually " +
+              f"and remove {coverage_path('historical_data', exchange, symbol_exchange, interval)} to have it rebuilt")
+
+def get_historical_klines_concurrent(jobs, max_workers=None):
+    '''
+    Runs several get_historical_klines jobs at the same time. Each job is a dict with the 
+    keyword arguments of get_historical_klines (symbol, interval, exchange and optionally 
+    start_date, end_date, step_size and concurrent_steps), and runs on a worker thread. 
+    Every job fetches several date ranges of its dataset at once, and the date ranges of 
+    all jobs on an exchange share that exchange's fetch pool. Requests to any one exchange 
+    are still spaced out by wait_for_rate_limit, which means the total run time is bounded 
+    by the busiest exchange's rate limit rather than by the sum of every request's 
+    latency, even for a single long dataset.
+
+    A failing job does not stop the others. Its partial file is left in place, so 
+    rerunning the same jobs resumes where it stopped.
+
+    :param jobs: List of dicts of get_historical_klines keyword arguments
+    :param max_workers: Maximum number of jobs running at once (default: all of them, up 
+        to session_pool_size)
+    :return: Dict mapping the index of every failed job to its exception
+    '''
+    if len(jobs) == 0:
+        return {}
+
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(jobs), session_pool_size)) as executor:
+        futures = {executor.submit(get_historical_klines, **job): i for i, job in enumerate(jobs)}
+
+        for future in as_completed(futures):
+            i = futures[future]
+            if future.exception() is not None:
+                failures[i] = future.exception()
+                print(f"Job failed: {jobs[i]['exchange']} | {jobs[i]['symbol']} {jobs[i]['interval']}: {failures[i]!r}")
+
+    print(f"{len(jobs) - len(failures)}/{len(jobs)} jobs complete")
+
+    return failures
 
 def request_missing_data(symbol, interval, exchange):
     '''
@@ -543,67 +1033,159 @@ def request_missing_data(symbol, interval, exchange):
     unavailable, while other times it is because something went wrong when collecting 
     the data. This is meant to address the latter case. The former case will be addressed 
     later with imputation.
+
+    The coverage index is left as it is, since the returned data is only stored once the 
+    caller writes it. repair_dataset writes the data and then updates the index.
+    '''
+    historical_data, _, _, _ = _request_missing_data(symbol, interval, exchange)
+    return historical_data
+
+def _request_missing_data(symbol, interval, exchange):
+    '''
+    request_missing_data, also returning the number of rows recovered, whether the data
+    differs from what is stored (recovered rows, or duplicate or unsorted rows cleaned up)
+    and the updated coverage index. The index is not saved, as it must only describe the
+    data once it is on disk.
     '''
     symbol_exchange = symbol_map[symbol][exchange]
-    raw_file = f'historical_data/{exchange}_{symbol_exchange}_{interval}_data_raw.csv'
+    raw_file = dataset_path('historical_data', exchange, symbol_exchange, interval, 'raw')
 
-    if not os.path.isfile(raw_file):
-        print("Raw file does not exist")
-        return None
+    if not dataset_exists(raw_file):
+        print(f"Raw file {raw_file} does not exist")
+        return None, 0, False, None
 
-    historical_data = pl.read_csv(raw_file)
+    historical_data = read_dataset(raw_file)
     if historical_data['volume'].dtype != pl.Float64:
         historical_data = historical_data.with_columns(historical_data['volume'].cast(pl.Float64).alias('volume'))
     
-    historical_data = historical_data.unique(subset=['start']).sort(by='start')
+    cleaned = not (historical_data['start'].diff().drop_nulls() > 0).all()
+    if cleaned:
+        historical_data = historical_data.unique(subset=['start']).sort(by='start')
     initial_length = len(historical_data)
+    step = interval_seconds[interval]
 
-    min_timestamp = historical_data['start'].min()
-    max_timestamp = historical_data['start'].max()
-    all_timestamps = pl.DataFrame({
-        'start': range(min_timestamp, max_timestamp + 1, 60)
-    })
+    # Find the missing ranges, leaving out those the exchange is known not to have
+    coverage = get_coverage('historical_data', exchange, symbol_exchange, interval)
+    missing = missing_ranges(coverage)
+    windows = coalesce_ranges(missing, exchange_page_limits[exchange], step)
 
-    # Find the missing timestamps
-    missing_timestamps = all_timestamps.join(historical_data.select('start'), on='start', how='anti')
+    print(f"{sum((last - first) // step + 1 for first, last in missing)} missing rows in {len(missing)} ranges, " +
+          f"requesting {len(windows)} pages for {raw_file}")
 
-    days_with_missing_data = missing_timestamps.with_columns(pl.from_epoch('start', time_unit='s'))\
-        .with_columns(pl.col('start').dt.strftime('%Y-%m-%d').alias('start'))\
-        .unique()\
-        .to_series()
-    
-    print(f"{len(days_with_missing_data)} dates identified with missing data for {raw_file}")
-    
-    for start_date in days_with_missing_data:
-        end_datetime = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1)
-        end_date = end_datetime.strftime('%Y-%m-%d')
+    missing_starts = pl.Series('start', [start for first, last in missing for start in range(first, last + 1, step)], dtype=pl.Int64)
+    recovered_data = []
 
-        sub_df_klines = get_klines_subset(symbol_exchange, interval, start_date, end_date, exchange)
+    for first, last in windows:
+        sub_df_klines = get_klines_subset(symbol_exchange, interval, first, last + step, exchange)
 
         if 'volume' not in sub_df_klines.columns:
             sub_df_klines = sub_df_klines.with_columns(pl.lit(None).cast(pl.Float64).alias('volume'))
 
-        historical_data = pl.concat([historical_data, sub_df_klines])
-    
-    historical_data = historical_data.unique(subset=['start']).sort(by='start')
+        # Windows can span candles that are already stored, only the missing ones are kept
+        recovered_data.append(sub_df_klines.filter(pl.col('start').is_in(missing_starts)))
+
+    if len(recovered_data) > 0:
+        recovered_data = pl.concat(recovered_data).unique(subset=['start']).sort(by='start')
+        historical_data = historical_data.merge_sorted(recovered_data.select(historical_data.columns), key='start')
+
     final_length = len(historical_data)
 
     if final_length > initial_length:
-        print(f"New rows added to {raw_file}")
+        mark_covered(coverage, recovered_data['start'].to_numpy())
+        print(f"{final_length - initial_length} new rows added to {raw_file}")
     else:
         print(f"{raw_file} unchanged")
 
-    return historical_data
+    # Whatever is still missing after asking again unavailable_after_attempts times is not 
+    # available from the exchange
+    record_attempts(coverage, missing_ranges(coverage))
 
-def repair_raw_data(interval='1m'):
+    return historical_data, final_length - initial_length, cleaned or final_length > initial_length, coverage
+
+def repair_dataset(symbol, interval, exchange):
     '''
-    Goes through all raw data files and attempts to re-request missing data, then updates the files.
+    Re-requests the missing data of one raw dataset and replaces the dataset if anything 
+    changed. The dataset is replaced atomically, so an interruption leaves either the old 
+    or the new data on disk, never a partly written file. The coverage index is saved only 
+    after the data, so it never claims rows that are not on disk.
+
+    :return: Dict with the number of rows recovered and requests sent, or None if the raw 
+        dataset does not exist
     '''
-    for symbol in symbol_map.keys():
-        for exchange in symbol_map[symbol].keys():
-            symbol_exchange = symbol_map[symbol][exchange]
-            raw_file = f'historical_data/{exchange}_{symbol_exchange}_{interval}_data_raw.csv'
+    symbol_exchange = symbol_map[symbol][exchange]
+    raw_file = dataset_path('historical_data', exchange, symbol_exchange, interval, 'raw')
 
-            repaired_data = request_missing_data(symbol, interval, exchange)
+    if not dataset_exists(raw_file):
+        return None
+
+    requests_before = request_count()
+    repaired_data, rows_recovered, modified, coverage = _request_missing_data(symbol, interval, exchange)
+
+    if modified:
+        write_dataset(repaired_data, raw_file)
+    save_coverage(coverage, 'historical_data', exchange, symbol_exchange, interval)
 
-            repaired_data.write_csv(raw_file)
+    return {'rows_recovered': rows_recovered, 'requests': request_count() - requests_before}
+
+def repair_raw_data(interval='1m', max_workers=None, workers_per_exchange=1):
+    '''
+    Goes through all raw data files and attempts to re-request missing data, then updates 
+    the files. Datasets are repaired in parallel threads like 
+    get_historical_klines_concurrent, with requests to each exchange still spaced out by 
+    its own rate limit. Datasets that have not been downloaded are skipped, and a failing 
+    dataset does not stop the others.
+
+    Every running repair holds a whole raw dataset in memory, and requests to one exchange 
+    cannot go faster than its rate limit anyway, so only workers_per_exchange datasets of 
+    each exchange are repaired at once.
+
+    :param interval: The interval of the datasets to repair
+    :param max_workers: Maximum number of datasets repaired at once (default: 
+        workers_per_exchange for every exchange)
+    :param workers_per_exchange: Maximum number of datasets of one exchange repaired at once
+    :return: DataFrame with the rows recovered, requests sent and time taken per dataset
+    '''
+    exchanges = list(dict.fromkeys(exchange for symbol in symbol_map.keys() for exchange in symbol_map[symbol].keys()))
+
+    # Ordered symbol by symbol, so the workers are spread over all exchanges
+    jobs = [(symbol, exchange) for symbol in symbol_map.keys() for exchange in exchanges if exchange in symbol_map[symbol]]
+    exchange_slots = {exchange: threading.BoundedSemaphore(workers_per_exchange) for exchange in exchanges}
+
+    def timed_repair(symbol, exchange):
+        with exchange_slots[exchange]:
+            start_time = time.perf_counter()
+            result = repair_dataset(symbol, interval, exchange)
+            return result, time.perf_counter() - start_time
+
+    results = []
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(jobs), workers_per_exchange * len(exchanges))) as executor:
+        futures = {executor.submit(timed_repair, symbol, exchange): (symbol, exchange) for symbol, exchange in jobs}
+
+        for future in as_completed(futures):
+            symbol, exchange = futures[future]
+            row = {'exchange': exchange, 'symbol': symbol, 'rows_recovered': None, 'requests': None, 'seconds': None, 'error': None}
+
+            if future.exception() is not None:
+                row['error'] = repr(future.exception())
+                print(f"Repair failed: {exchange} | {symbol} {interval}: {row['error']}")
+            else:
+                result, seconds = future.result()
+                if result is None:
+                    continue
+                row.update(result)
+                row['seconds'] = round(seconds, 1)
+
+            results.append(row)
+
+    results = pl.DataFrame(results, schema={
+        'exchange': pl.String, 'symbol': pl.String, 'rows_recovered': pl.Int64, 
+        'requests': pl.Int64, 'seconds': pl.Float64, 'error': pl.String
+    }).sort(by=['symbol', 'exchange'])
+
+    print(f"Repaired {results.height} datasets in {round(time.perf_counter() - start_time, 1)} s: " + 
+          f"{results['rows_recovered'].sum()} rows recovered with {results['requests'].sum()} requests")
+    print(results)
+
+    return results
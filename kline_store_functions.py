@@ -0,0 +1,216 @@
+import os
+import json
+import shutil
+from datetime import datetime, timezone
+import numpy as np
+import polars as pl
+from exchange_maps import *
+from storage_functions import *
+
+# A kline store keeps a dataset on a dense time grid (as complete datasets are after
+# impute_missing_data) as one raw binary file per column, next to a header.json holding
+# the first start, the interval, the number of rows and the dtype of every column. The
+# start column itself is not stored: the candle at time T is row (T - base) // interval.
+# Columns are opened with np.memmap, so opening a store reads nothing but the header and
+# every slice is a view of the mapped file.
+
+
+def kline_store_path(folder, exchange, symbol_exchange, interval, stage='complete'):
+    return os.path.join(folder, f'{exchange}_{symbol_exchange}_{interval}_data_{stage}.klines')
+
+def _column_file(path, column):
+    return os.path.join(path, f'{column}.bin')
+
+def _save_header(path, header):
+    with open(os.path.join(path, 'header.json.tmp'), 'w') as f:
+        json.dump(header, f, indent=4)
+    os.replace(os.path.join(path, 'header.json.tmp'), os.path.join(path, 'header.json'))
+
+def _load_header(path):
+    with open(os.path.join(path, 'header.json')) as f:
+        return json.load(f)
+
+def _check_dense(historical_data, interval):
+    if historical_data.height > 1 and not (historical_data['start'].diff().drop_nulls() == interval_seconds[interval]).all():
+        raise ValueError(f"Kline stores need consecutive {interval} candles without gaps or duplicates")
+
+def write_kline_store(historical_data, path, interval='1m'):
+    '''
+    Write a whole kline store from a sorted, gap-free DataFrame, replacing whatever was
+    stored at path before.
+    '''
+    _check_dense(historical_data, interval)
+
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    columns = [column for column in historical_data.columns if column != 'start']
+    for column in columns:
+        historical_data[column].to_numpy().tofile(_column_file(tmp_path, column))
+
+    _save_header(tmp_path, {
+        'base': int(historical_data['start'][0]) if historical_data.height > 0 else None,
+        'interval': interval,
+        'nrows': historical_data.height,
+        'columns': {column: str(historical_data[column].to_numpy().dtype) for column in columns}
+    })
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+def append_kline_store(historical_data, path):
+    '''
+    Append a sorted, gap-free DataFrame to a kline store. Rows from the first start on
+    replace the stored ones, so the last candles can be rewritten (e.g. the still open
+    bucket of a rollup), but the first row must not leave a gap after the store. The
+    column files are written before the header, so an interrupted append leaves the
+    store as it was (bytes beyond nrows are cut off by the next append).
+    '''
+    header = _load_header(path)
+    step = interval_seconds[header['interval']]
+
+    if header['nrows'] == 0:
+        return write_kline_store(historical_data, path, header['interval'])
+    if historical_data.height == 0:
+        return
+
+    first_row = (historical_data['start'][0] - header['base']) // step
+    if not 0 <= first_row <= header['nrows'] or historical_data['start'][0] % step != header['base'] % step:
+        raise ValueError(f"Appended rows start at {historical_data['start'][0]}, the store continues at {header['base'] + header['nrows'] * step}")
+    _check_dense(historical_data, header['interval'])
+
+    for column, dtype in header['columns'].items():
+        with open(_column_file(path, column), 'r+b') as f:
+            f.truncate(first_row * np.dtype(dtype).itemsize)
+            f.seek(0, os.SEEK_END)
+            historical_data[column].to_numpy().astype(dtype).tofile(f)
+
+    header['nrows'] = first_row + historical_data.height
+    _save_header(path, header)
+
+def open_kline_store(path):
+    '''
+    Open a kline store. Only the header is read, the columns are memory-mapped.
+
+    :return: Dict with the header fields and 'columns' mapping every column name to a
+        read-only np.memmap (or an empty array for an empty store)
+    '''
+    store = _load_header(path)
+
+    store['columns'] = {
+        column: np.memmap(_column_file(path, column), dtype=dtype, mode='r', shape=(store['nrows'],))
+        if store['nrows'] > 0 else np.empty(0, dtype=dtype)
+        for column, dtype in store['columns'].items()
+    }
+
+    return store
+
+def kline_store_index(store, timestamp):
+    '''
+    Row of the candle starting at timestamp, or of the candle containing it if it falls
+    inside one. Raises IndexError if the store does not cover the timestamp.
+    '''
+    row = (timestamp - store['base']) // interval_seconds[store['interval']] if store['nrows'] > 0 else -1
+
+    if not 0 <= row < store['nrows']:
+        raise IndexError(f"{timestamp} is outside of the kline store")
+
+    return row
+
+def kline_store_slice(store, start=None, end=None, columns=None):
+    '''
+    Candles from start up to (not including) end, both unix timestamps defaulting to
+    the whole store. Bounds outside of the store are clipped.
+
+    :return: Dict of the requested columns as views of the mapped files, plus a 'start'
+        array built from the row numbers
+    '''
+    step = interval_seconds[store['interval']]
+    base = store['base'] or 0
+
+    first = 0 if start is None else min(max(-(-(start - base) // step), 0), store['nrows'])
+    last = store['nrows'] if end is None else min(max(-(-(end - base) // step), first), store['nrows'])
+
+    klines = {'start': base + step * np.arange(first, last, dtype=np.int64)}
+    for column in columns or store['columns'].keys():
+        if column != 'start':
+            klines[column] = store['columns'][column][first:last]
+
+    return klines
+
+def update_kline_store(source_path):
+    '''
+    Create or extend the kline store of a complete or rollup dataset, next to it. Only
+    the rows from the last stored candle on are read from the dataset.
+
+    :return: Path of the kline store
+    '''
+    exchange, symbol_exchange, interval, stage = parse_dataset_path(source_path)
+    path = kline_store_path(os.path.dirname(source_path), exchange, symbol_exchange, interval, stage)
+
+    if not os.path.isdir(path):
+        write_kline_store(read_dataset(source_path).sort(by='start'), path, interval)
+        return path
+
+    header = _load_header(path)
+    historical_data = scan_dataset(source_path)
+    if header['nrows'] > 0:
+        historical_data = historical_data.filter(pl.col('start') >= header['base'] + (header['nrows'] - 1) * interval_seconds[interval])
+
+    append_kline_store(historical_data.collect().sort(by='start'), path)
+
+    return path
+
+def update_kline_stores(preprocessed_data_folder, stages=('complete', 'rollup')):
+    '''
+    Create or extend the kline stores of every complete and rollup dataset in
+    preprocessed_data_folder.
+    '''
+    for stage in stages:
+        for path in list_datasets(preprocessed_data_folder, stage):
+            update_kline_store(path)
+
+def to_timestamp(date):
+    # 'yyyy-mm-dd' (or an ISO datetime) in UTC, or a unix timestamp in seconds
+    if isinstance(date, str):
+        return int(datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp())
+    return int(date)
+
+def load_klines(symbol, exchange, interval='1m', start=None, end=None, columns=None,
+                folder='preprocessed_data', stage='complete'):
+    '''
+    Load the candles of a symbol on an exchange between start and end, reading as little
+    as possible. The kline store of the dataset is used if it covers the whole range,
+    otherwise the dataset is scanned with the range and columns pushed down into the
+    reader.
+
+    :param symbol: The symbol, as in symbol_map
+    :param exchange: The exchange, resolved to its own ticker through symbol_map
+    :param interval: The interval of the candles
+    :param start: First candle, as 'yyyy-mm-dd' or a unix timestamp (default: the first stored)
+    :param end: End of the range, exclusive, in the same formats (default: after the last stored)
+    :param columns: Columns to return besides 'start' (default: all)
+    :param folder: Folder of the dataset
+    :param stage: Stage of the dataset, e.g. 'complete', 'rollup' or 'raw'
+    :return: DataFrame sorted by start
+    '''
+    symbol_exchange = symbol_map[symbol][exchange]
+    start = None if start is None else to_timestamp(start)
+    end = None if end is None else to_timestamp(end)
+    columns = None if columns is None else ['start'] + [column for column in columns if column != 'start']
+
+    store_path = kline_store_path(folder, exchange, symbol_exchange, interval, stage)
+    if end is not None and os.path.isdir(store_path):
+        store = open_kline_store(store_path)
+        store_end = (store['base'] or 0) + store['nrows'] * interval_seconds[interval]
+        if store['nrows'] > 0 and end <= store_end and (columns is None or all(column in store['columns'] for column in columns[1:])):
+            return pl.DataFrame(kline_store_slice(store, start, end, columns))
+
+    historical_data = scan_dataset(dataset_path(folder, exchange, symbol_exchange, interval, stage), start, end)
+    if columns is not None:
+        historical_data = historical_data.select(columns)
+
+    return historical_data.collect().sort(by='start')
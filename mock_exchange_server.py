@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import subprocess
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from import_historical_data_functions import *
+
+# A local stand-in for the exchanges' REST APIs, serving synthetic 1m candles in the same
+# response formats as the real kline endpoints. Every exchange is served under its own
+# path prefix, e.g. http://127.0.0.1:{port}/okx/api/v5/market/history-index-candles,
+# and use_mock_exchange_server points exchange_api_urls at them.
+
+mock_exchange_defaults = {
+    'latency': 0.0,                 # Seconds added to every response
+    'page_limits': dict(exchange_page_limits),
+    'gap_probability': 0.0,         # Share of candles that the exchange does not have
+    'rate_limit_probability': 0.0,  # Share of requests answered with a 429
+    'drop_probability': 0.0,        # Share of requests whose connection is closed without a response
+    'listing_unix': 1483228800,     # No candles before this timestamp (2017-01-01)
+    'seed': 0
+}
+
+
+#------------------------------------------------------------
+# Synthetic candles
+
+def mock_candles(first_unix, last_unix, config):
+    '''
+    The candles the mock exchange has between first_unix and last_unix (both inclusive).
+    Prices and gaps only depend on the timestamp, so every request sees the same market.
+    '''
+    first_unix = max(first_unix + (-first_unix) % 60, config['listing_unix'])
+    last_unix = min(last_unix, int(time.time()) // 60 * 60 - 60)
+
+    start = np.arange(first_unix, last_unix + 1, 60, dtype=np.int64)
+
+    # Knuth's multiplicative hash of the candle index decides whether the candle is missing
+    if config['gap_probability'] > 0:
+        hashed = ((start // 60 + config['seed']) * 2654435761) % 2**32
+        start = start[hashed >= config['gap_probability'] * 2**32]
+
+    close = 30000 + 2000 * np.sin(start / 300000) + 50 * np.sin(start / 977)
+    open_ = 30000 + 2000 * np.sin((start - 60) / 300000) + 50 * np.sin((start - 60) / 977)
+
+    return {
+        'start': start,
+        'open': open_,
+        'high': np.maximum(open_, close) + 5,
+        'low': np.minimum(open_, close) - 5,
+        'close': close,
+        'volume': 10 + 5 * np.cos(start / 3600)
+    }
+
+def _rows(candles, fields, ms, numbers=False):
+    # One list per candle, with prices as strings unless numbers is set
+    rows = []
+
+    for i in range(len(candles['start'])):
+        row = []
+        for field in fields:
+            if field == 'start':
+                row.append(int(candles['start'][i]) * (1000 if ms else 1))
+            elif field in candles:
+                row.append(round(float(candles[field][i]), 2) if numbers else f"{candles[field][i]:.2f}")
+            else:
+                row.append(field)
+        rows.append(row)
+
+    return rows
+
+def _int(params, name, default=None):
+    return int(params[name][0]) if name in params else default
+
+#------------------------------------------------------------
+# Exchange endpoints
+# Each takes the query parameters and returns the response body
+
+def _mock_binance_klines(params, config):
+    limit = min(_int(params, 'limit', 500), config['page_limits']['binance'])
+    candles = mock_candles(_int(params, 'startTime') // 1000, _int(params, 'endTime') // 1000, config)
+    candles = {field: values[:limit] for field, values in candles.items()}
+
+    return [row + [row[0] + 59999, "0", 0, "0", "0", "0"] for row in _rows(candles, ['start', 'open', 'high', 'low', 'close', 'volume'], ms=True)]
+
+def _mock_coinbase_candles(params, config):
+    candles = mock_candles(_int(params, 'start'), _int(params, 'end'), config)
+    if len(candles['start']) > config['page_limits']['coinbase']:
+        raise ValueError("number of candles requested should be less than 300")
+
+    rows = _rows(candles, ['start', 'low', 'high', 'open', 'close', 'volume'], ms=False)[::-1]
+    return {'candles': [dict(zip(['start', 'low', 'high', 'open', 'close', 'volume'], [str(row[0])] + row[1:])) for row in rows]}
+
+def _mock_bybit_kline(params, config):
+    limit = min(_int(params, 'limit', 200), config['page_limits']['bybit'])
+    candles = mock_candles(_int(params, 'start') // 1000, _int(params, 'end') // 1000, config)
+    candles = {field: values[-limit:] for field, values in candles.items()}
+
+    rows = [[str(row[0])] + row[1:] + ["0"] for row in _rows(candles, ['start', 'open', 'high', 'low', 'close', 'volume'], ms=True)]
+    return {'retCode': 0, 'retMsg': 'OK', 'result': {'category': params['category'][0], 'symbol': params['symbol'][0], 'list': rows[::-1]}}
+
+def _mock_okx_history_index_candles(params, config):
+    # before and after are exclusive bounds, and the newest candles are returned first
+    limit = config['page_limits']['okx']
+    candles = mock_candles(_int(params, 'before') // 1000 + 1, (_int(params, 'after') - 1) // 1000, config)
+    candles = {field: values[-limit:] for field, values in candles.items()}
+
+    rows = [[str(row[0])] + row[1:] + ["1"] for row in _rows(candles, ['start', 'open', 'high', 'low', 'close'], ms=True)]
+    return {'code': '0', 'msg': '', 'data': rows[::-1]}
+
+def _mock_digifinex_kline(params, config):
+    limit = config['page_limits']['digifinex']
+    candles = mock_candles(_int(params, 'start_time'), _int(params, 'end_time'), config)
+    candles = {field: values[:limit] for field, values in candles.items()}
+
+    return {'code': 0, 'data': _rows(candles, ['start', 'volume', 'close', 'high', 'low', 'open'], ms=False, numbers=True)}
+
+def _mock_bitget_history_candles(params, config):
+    # The limit candles before endTime
+    limit = min(_int(params, 'limit', 100), config['page_limits']['bitget'])
+    end_unix = _int(params, 'endTime') // 1000
+    candles = mock_candles(end_unix - 60 * limit, end_unix - 60, config)
+
+    rows = [[str(row[0])] + row[1:] + [row[-1], row[-1]] for row in _rows(candles, ['start', 'open', 'high', 'low', 'close', 'volume'], ms=True)]
+    return {'code': '00000', 'msg': 'success', 'requestTime': int(time.time() * 1000), 'data': rows}
+
+def _mock_binance_exchange_info(params, config):
+    return {'symbols': [{'symbol': symbol_map[symbol]['binance']} for symbol in symbol_map if 'binance' in symbol_map[symbol]]}
+
+def _mock_coinbase_products(params, config):
+    return {'products': [{'product_id': symbol_map[symbol]['coinbase']} for symbol in symbol_map if 'coinbase' in symbol_map[symbol]]}
+
+mock_endpoints = {
+    ('binance', '/api/v3/klines'): _mock_binance_klines,
+    ('binance', '/api/v3/exchangeInfo'): _mock_binance_exchange_info,
+    ('coinbase', '/api/v3/brokerage/products'): _mock_coinbase_products,
+    ('bybit', '/v5/market/kline'): _mock_bybit_kline,
+    ('okx', '/api/v5/market/history-index-candles'): _mock_okx_history_index_candles,
+    ('digifinex', '/v3/kline'): _mock_digifinex_kline,
+    ('bitget', '/api/v2/spot/market/history-candles'): _mock_bitget_history_candles
+}
+
+def _mock_endpoint(exchange, path):
+    # Coinbase has the product in the path of its candles endpoint
+    if exchange == 'coinbase' and path.startswith('/api/v3/brokerage/market/products/') and path.endswith('/candles'):
+        return _mock_coinbase_candles
+    return mock_endpoints.get((exchange, path))
+
+#------------------------------------------------------------
+# Server
+
+class MockExchangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are sent separately, which with Nagle's algorithm stalls every
+    # response on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        _, exchange, path = url.path.split('/', 2)
+        endpoint = _mock_endpoint(exchange, '/' + path)
+
+        with server.stats_lock:
+            server.stats['requests'] += 1
+            fault = server.random.random()
+
+        if server.config['latency'] > 0:
+            time.sleep(server.config['latency'])
+
+        if fault < server.config['drop_probability']:
+            with server.stats_lock:
+                server.stats['dropped'] += 1
+            self.close_connection = True
+            return
+
+        if fault < server.config['drop_probability'] + server.config['rate_limit_probability']:
+            with server.stats_lock:
+                server.stats['rate_limited'] += 1
+            return self._respond(429, {'msg': 'Too many requests'})
+
+        if endpoint is None:
+            return self._respond(404, {'msg': f'Unknown endpoint {url.path}'})
+
+        try:
+            body = endpoint(parse_qs(url.query), server.config)
+        except (KeyError, ValueError) as e:
+            return self._respond(400, {'msg': str(e)})
+
+        self._respond(200, body)
+
+    def _respond(self, status, body):
+        body = json.dumps(body, separators=(',', ':')).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_exchange_server(port=0, **config):
+    '''
+    Start the mock exchange server on a background thread of this process. The keyword
+    arguments override mock_exchange_defaults. Stop it with server.shutdown().
+
+    :return: The server. server.server_address holds the port, server.stats the number of
+        requests, dropped connections and 429s so far
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockExchangeHandler)
+    server.daemon_threads = True
+    server.config = {**mock_exchange_defaults, **config}
+    server.random = random.Random(server.config['seed'])
+    server.stats = {'requests': 0, 'dropped': 0, 'rate_limited': 0}
+    server.stats_lock = threading.Lock()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def start_mock_exchange_process(**config):
+    '''
+    Start the mock exchange server in a separate Python process, so that the time it
+    spends building responses is not counted as CPU time of the process under test.
+
+    :return: (process, port). Stop it with process.terminate().
+    '''
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import sys, json; from mock_exchange_server import *; serve_mock_exchange(**json.loads(sys.argv[1]))', json.dumps(config)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True
+    )
+    port = int(process.stdout.readline())
+
+    return process, port
+
+def serve_mock_exchange(port=0, **config):
+    # Entry point of start_mock_exchange_process. Prints the port, then serves forever.
+    server = start_mock_exchange_server(port, **config)
+    print(server.server_address[1], flush=True)
+
+    while True:
+        time.sleep(3600)
+
+def use_mock_exchange_server(port):
+    '''
+    Point exchange_api_urls at a mock exchange server on this machine.
+
+    :return: The previous exchange_api_urls, to restore them with exchange_api_urls.update()
+    '''
+    previous_urls = dict(exchange_api_urls)
+
+    for exchange in exchange_api_urls.keys():
+        exchange_api_urls[exchange] = f'http://127.0.0.1:{port}/{exchange}'
+
+    return previous_urls
+
+
+if __name__ == '__main__':
+    serve_mock_exchange(port=8000)
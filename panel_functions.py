@@ -0,0 +1,139 @@
+import os
+import json
+import shutil
+import numpy as np
+import polars as pl
+from exchange_maps import *
+from storage_functions import *
+
+# A panel holds one symbol's candles from every exchange on a shared, dense time axis, as
+# a values array of shape (timestamps, exchanges, fields) and a mask array of shape
+# (timestamps, exchanges) that is True where the exchange has a candle. Both are stored as
+# .npy files, so load_panel can memory-map them instead of reading them, next to a
+# meta.json describing the axes.
+
+panel_fields = ['open', 'high', 'low', 'close', 'volume']
+
+
+def panel_path(panel_folder, symbol, interval):
+    return os.path.join(panel_folder, f'{symbol}_{interval}')
+
+def _panel_source_path(preprocessed_data_folder, exchange, symbol_exchange, interval):
+    # 1m data comes from the complete datasets, coarser intervals from their rollups if
+    # they were not preprocessed from downloaded data
+    complete_path = dataset_path(preprocessed_data_folder, exchange, symbol_exchange, interval, 'complete')
+    if dataset_exists(complete_path):
+        return complete_path
+
+    rollup_path = dataset_path(preprocessed_data_folder, exchange, symbol_exchange, interval, 'rollup')
+    if dataset_exists(rollup_path):
+        return rollup_path
+
+    return None
+
+def build_panel(symbol, interval='1m', preprocessed_data_folder='preprocessed_data', panel_folder='panel_data',
+                fields=None, exchanges=None, dtype=np.float64):
+    '''
+    Build the panel of a symbol from the preprocessed datasets of every exchange that
+    symbol_map lists it on, replacing any previous panel. The time axis runs from the
+    first to the last candle of any exchange. Cells of exchanges without a candle at a
+    timestamp hold NaN and are False in the mask.
+
+    :param symbol: The symbol, as in symbol_map
+    :param interval: The interval of the candles
+    :param fields: Columns to include (default: panel_fields)
+    :param exchanges: Exchanges to include (default: all exchanges with data for the symbol)
+    :param dtype: Data type of the values array
+    :return: Path of the panel, or None if no exchange has data for the symbol
+    '''
+    fields = fields or panel_fields
+    exchanges = exchanges or list(symbol_map[symbol].keys())
+    step = interval_seconds[interval]
+
+    sources = {}
+    for exchange in exchanges:
+        source_path = _panel_source_path(preprocessed_data_folder, exchange, symbol_map[symbol][exchange], interval)
+        if source_path is not None:
+            sources[exchange] = source_path
+
+    if len(sources) == 0:
+        print(f"No preprocessed data for {symbol} {interval}")
+        return None
+
+    exchanges = list(sources.keys())
+    bounds = pl.concat([
+        scan_dataset(source_path).select(pl.col('start').min().alias('first'), pl.col('start').max().alias('last')).collect()
+        for source_path in sources.values()
+    ])
+    first_start = bounds['first'].min()
+    n_timestamps = (bounds['last'].max() - first_start) // step + 1
+
+    path = panel_path(panel_folder, symbol, interval)
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    values = np.lib.format.open_memmap(os.path.join(tmp_path, 'values.npy'), mode='w+', dtype=dtype,
+                                       shape=(n_timestamps, len(exchanges), len(fields)))
+    mask = np.lib.format.open_memmap(os.path.join(tmp_path, 'mask.npy'), mode='w+', dtype=np.bool_,
+                                     shape=(n_timestamps, len(exchanges)))
+    values[:] = np.nan
+    mask[:] = False
+
+    for i, exchange in enumerate(exchanges):
+        exchange_data = read_dataset(sources[exchange], columns=['start'] + fields)
+        rows = (exchange_data['start'].to_numpy() - first_start) // step
+
+        values[rows, i, :] = exchange_data.select(fields).to_numpy().astype(dtype)
+        mask[rows, i] = True
+
+    values.flush()
+    mask.flush()
+    del values, mask
+
+    meta = {
+        'symbol': symbol,
+        'interval': interval,
+        'first_start': int(first_start),
+        'step': step,
+        'n_timestamps': int(n_timestamps),
+        'exchanges': exchanges,
+        'exchange_symbols': [symbol_map[symbol][exchange] for exchange in exchanges],
+        'fields': fields
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+    print(f"Built panel {path}: {n_timestamps} timestamps x {len(exchanges)} exchanges x {len(fields)} fields")
+
+    return path
+
+def load_panel(symbol, interval='1m', panel_folder='panel_data', mode='r'):
+    '''
+    Open a panel built by build_panel. The arrays are memory-mapped, so opening is
+    instant and only the parts that are used are read from disk.
+
+    :return: Dict with the meta data, 'start' (the time axis), 'values' and 'mask'
+    '''
+    path = panel_path(panel_folder, symbol, interval)
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        panel = json.load(f)
+
+    panel['start'] = panel['first_start'] + panel['step'] * np.arange(panel['n_timestamps'], dtype=np.int64)
+    panel['values'] = np.load(os.path.join(path, 'values.npy'), mmap_mode=mode)
+    panel['mask'] = np.load(os.path.join(path, 'mask.npy'), mmap_mode=mode)
+
+    return panel
+
+def panel_field(panel, field):
+    '''
+    One field of a panel as a (timestamps, exchanges) array, e.g. the close of every
+    exchange for a lead-lag analysis.
+    '''
+    return panel['values'][:, :, panel['fields'].index(field)]
@@ -1,19 +1,44 @@
+import os
 import polars as pl
 from preprocess_data_functions import *
+from panel_functions import *
 
 raw_data_folder = 'historical_data'
 preprocessed_data_folder = 'preprocessed_data'
 
-# Preprocess all data in raw_data_folder and output to preprocessed_data_folder
-preprocess_data(raw_data_folder, preprocessed_data_folder)
+# The worker processes used by preprocess_data re-import this script, so everything 
+# that runs here is behind the main guard
+if __name__ == '__main__':
+    # CSV datasets written before the Parquet storage backend are still found and 
+    # updated as CSV (see dataset_path), and can be converted once with:
+    # migrate_csv_to_parquet(raw_data_folder)
+    # migrate_csv_to_parquet(preprocessed_data_folder)
 
+    # Preprocess all data in raw_data_folder and output to preprocessed_data_folder, 
+    # one dataset per core while the estimated memory use stays within the budget
+    preprocess_data(raw_data_folder, preprocessed_data_folder, workers=os.cpu_count(), memory_budget_gb=16)
 
-# View preprocessed data
-symbol = 'BTCUSD'
-interval = '1m'
-exchange = 'coinbase'
+    # Build or update the 5m to 1d datasets from the complete 1m data, so coarser 
+    # intervals never have to be downloaded
+    rollup_data(preprocessed_data_folder)
 
-complete_file = f'preprocessed_data/{exchange}_{symbol_map[symbol][exchange]}_{interval}_data_complete.csv'
+    # Keep a memory-mapped kline store next to every complete and rollup dataset, for 
+    # random access by timestamp without reading the dataset
+    update_kline_stores(preprocessed_data_folder)
 
-historical_data = pl.read_csv(complete_file)
-plot_data(historical_data, 'close_pct_change')
+    # Align every symbol across exchanges into one memory-mapped panel per interval, 
+    # opened later with load_panel
+    for symbol in symbol_map.keys():
+        for interval in ['1m', '1h']:
+            build_panel(symbol, interval, preprocessed_data_folder)
+
+
+    # View preprocessed data
+    symbol = 'BTCUSD'
+    interval = '1m'
+    exchange = 'coinbase'
+
+    complete_file = dataset_path(preprocessed_data_folder, exchange, symbol_map[symbol][exchange], interval, 'complete')
+
+    historical_data = load_features(symbol, exchange, ['close_pct_change'], interval, folder=preprocessed_data_folder)
+    plot_data(historical_data, 'close_pct_change', complete_file)
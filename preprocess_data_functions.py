@@ -1,40 +1,59 @@
-import pandas as pd
+import numpy as np
 import polars as pl
-import matplotlib.pyplot as plt
 import os
 import glob
+import json
+import time
+import hashlib
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from exchange_maps import *
+from storage_functions import *
+from kline_store_functions import *
+from feature_functions import *
 
 
-def impute_missing_data(historical_data):
+def impute_missing_data(historical_data, interval='1m'):
     '''
     Impute missing rows. Imputed rows will have 0 volume, and the LHOC 
     values will all be the close value of the most recent "real" row.
+
+    Every row is placed directly at its position on the interval grid, 
+    (start - first start) / interval length, in freshly allocated column arrays, so 
+    the gaps are filled in one linear pass without joining, concatenating or sorting. 
+    All starts must lie on the grid, which they do for candles from the exchanges.
     '''
-    # Remove any duplicate rows (They should not be present, but this is a safeguard)
-    historical_data = historical_data.unique(subset=['start']).sort(by='start')
+    step = interval_seconds[interval]
+
+    # Remove any duplicate rows and sort (They should not be present, but this is a 
+    # safeguard, and only costs a copy if the data actually needs it)
+    if not (historical_data['start'].diff().drop_nulls() > 0).all():
+        historical_data = historical_data.unique(subset=['start']).sort(by='start')
 
-    # Generate a range of all possible timestamps from min to max with a step of 60 seconds
     min_timestamp = historical_data['start'].min()
-    max_timestamp = historical_data['start'].max()
-    all_timestamps = pl.DataFrame({
-        'start': range(min_timestamp, max_timestamp + 1, 60)
-    })
-
-    # Find the missing timestamps
-    missing_timestamps = all_timestamps.join(historical_data.select('start'), on='start', how='anti')
-
-    # Create a DataFrame with missing timestamps and default values
-    missing_data = missing_timestamps.with_columns([
-        pl.lit(None).cast(pl.Float64).alias('low'),
-        pl.lit(None).cast(pl.Float64).alias('high'),
-        pl.lit(None).cast(pl.Float64).alias('open'),
-        pl.lit(None).cast(pl.Float64).alias('close'),
-        pl.lit(0).cast(pl.Float64).alias('volume')
-    ])
+    offsets = historical_data['start'].to_numpy() - min_timestamp
+
+    if (offsets % step != 0).any():
+        raise ValueError(f"Timestamps do not all lie on the {interval} grid")
 
-    # Concatenate the original data with the missing data
-    complete_data = pl.concat([historical_data, missing_data]).sort(by='start')
+    positions = offsets // step
+    n_rows = int(positions[-1]) + 1
+
+    complete_data = {'start': min_timestamp + step * np.arange(n_rows, dtype=np.int64)}
+
+    for column in historical_data.columns:
+        if column == 'start':
+            continue
+
+        # Missing rows start out as NaN (0 for volume). NaN is turned into null below, 
+        # just like the nulls of the real rows, which keeps forward_fill and fill_null 
+        # behaving exactly as if the missing rows had been concatenated as nulls
+        values = np.zeros(n_rows) if column == 'volume' else np.full(n_rows, np.nan)
+        values[positions] = historical_data[column].cast(pl.Float64).to_numpy()
+        complete_data[column] = pl.Series(column, values, nan_to_null=True)
+
+    complete_data = pl.DataFrame(complete_data)
 
     # Forward-fill 'close' values
     complete_data = complete_data.with_columns(
@@ -50,14 +69,32 @@ def impute_missing_data(historical_data):
 
     return complete_data
 
-def remove_outliers(historical_data, max_change = 0.15):
+def remove_outliers(historical_data, max_change = 0.15, method='sweep', check_equivalence=False):
     '''
     Detect outliers by looking for too-large percent changes from one candle to the next. 
     a point is only removed if it corresponds to a large jump followed by a large drop 
     (or vice versa). A lone jump or drop will be ignored. This algorithm is definitely 
     not perfect, but it works well enough for the data I've downloaded, so I'm leaving it 
     as-is. For others it would be worthwhile to check the results for a specific dataset.
+
+    method='iterative' is the original implementation, which recomputes the percent 
+    changes of the whole frame after every removed row. method='sweep' (the default) 
+    removes exactly the same rows in a single pass, see _remove_outliers_sweep. With 
+    check_equivalence=True both are run and an AssertionError is raised if they differ.
     '''
+    if method == 'iterative':
+        return _remove_outliers_iterative(historical_data, max_change)
+    elif method != 'sweep':
+        raise ValueError(f"Unknown outlier removal method: {method}")
+
+    cleaned_data = _remove_outliers_sweep(historical_data, max_change)
+
+    if check_equivalence and not cleaned_data.equals(_remove_outliers_iterative(historical_data, max_change)):
+        raise AssertionError("Sweep and iterative outlier removal returned different rows")
+
+    return cleaned_data
+
+def _remove_outliers_iterative(historical_data, max_change):
     # Remove pct increases/decreases greater than max_change
     outliers = historical_data.with_columns(
         pl.col("close").pct_change().alias("close_pct_change")
@@ -82,51 +119,396 @@ def remove_outliers(historical_data, max_change = 0.15):
 
     return historical_data
 
-def preprocess_data(raw_data_folder, preprocessed_data_folder):
-    raw_data_files = [os.path.basename(file) for file in glob.glob(os.path.join(raw_data_folder, '*raw.csv'))]
+def _remove_outliers_sweep(historical_data, max_change):
+    '''
+    Single pass version of _remove_outliers_iterative. Percent changes are computed once, 
+    and the remaining rows are kept as a linked list so that removing a row only means 
+    recomputing the percent change of the row after it. That is the only percent change 
+    a removal can affect, so it is also the only row whose outlier status can change.
+
+    The iterative version restarts from the first outlier after every removal, but every 
+    pair of outliers before the one preceding the removed row was already compared with 
+    the same values and skipped, so stepping back by one outlier gives the same result.
+    '''
+    # Removing a row removes every row with the same start in the iterative version
+    if historical_data['start'].is_duplicated().any():
+        return _remove_outliers_iterative(historical_data, max_change)
+
+    close = historical_data['close'].cast(pl.Float64).to_numpy()
+    n_rows = len(close)
+
+    # Same arithmetic as pct_change, so the values match it exactly. Nulls become NaN, 
+    # which never compares as an outlier, just like a null percent change.
+    close_pct_change = np.full(n_rows, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        close_pct_change[1:] = (close[1:] - close[:-1]) / close[:-1]
+
+    outliers = np.flatnonzero((close_pct_change > max_change) | (close_pct_change < -max_change)).tolist()
+
+    previous_row = np.arange(-1, n_rows - 1)
+    next_row = np.arange(1, n_rows + 1)
+    removed = np.zeros(n_rows, dtype=bool)
+
+    # Zero and infinite closes are compared like the iterative version compares them
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i = 0
+        while len(outliers) - i > 1:
+            first_two = (close_pct_change[outliers[i]], close_pct_change[outliers[i + 1]])
+            first_two_prod = (first_two[0] + 1) * (first_two[1] + 1) - 1
+
+            if first_two_prod < max(first_two) and first_two_prod > min(first_two):
+                row = outliers.pop(i)
+                removed[row] = True
+
+                # An outlier always has a previous row, otherwise it would have no percent change
+                before, after = previous_row[row], next_row[row]
+                next_row[before] = after
+
+                if after < n_rows:
+                    previous_row[after] = before
+                    close_pct_change[after] = (close[after] - close[before]) / close[before]
+
+                    # The row after the removed one is the next remaining row, so if it is 
+                    # an outlier it is the one that now sits at position i
+                    is_outlier = close_pct_change[after] > max_change or close_pct_change[after] < -max_change
+                    was_outlier = i < len(outliers) and outliers[i] == after
+
+                    if is_outlier and not was_outlier:
+                        outliers.insert(i, after)
+                    elif was_outlier and not is_outlier:
+                        outliers.pop(i)
+
+                i = max(i - 1, 0)
+            else:
+                i += 1
+
+    return historical_data.filter(pl.Series(~removed))
+
+def add_derived_columns(complete_data):
+    '''
+    Add the percent change, difference and candle range columns that used to be written 
+    to every complete file. They are features now (see feature_functions).
+    '''
+    return compute_features(complete_data, derived_columns)
+
+def preprocess_historical_data(raw_historical_data, interval='1m'):
+    '''
+    Turn raw klines into complete data: remove outliers and impute missing rows. The 
+    complete data is OHLCV only, everything derived from it is loaded as features.
+    '''
+    if raw_historical_data['volume'].dtype != pl.Float64:
+        raw_historical_data = raw_historical_data.with_columns(raw_historical_data['volume'].cast(pl.Float64).alias('volume'))
+
+    # Remove outliers
+    complete_data = remove_outliers(raw_historical_data)
+
+    # Impute missing rows
+    complete_data = impute_missing_data(complete_data, interval)
+
+    return complete_data
+
+def watermark_path(complete_path):
+    return complete_path.removesuffix('.csv') + '.watermark.json'
+
+def _raw_data_hash(raw_historical_data):
+    # Row hashes are only stable within one polars version. A different hash just means 
+    # the dataset is preprocessed from scratch once.
+    return hashlib.sha256(raw_historical_data.hash_rows(seed=0).to_numpy().tobytes()).hexdigest()
+
+def _save_watermark(complete_path, raw_historical_data):
+    watermark = {
+        'last_start': int(raw_historical_data['start'].max()),
+        'raw_rows': raw_historical_data.height,
+        'raw_hash': _raw_data_hash(raw_historical_data)
+    }
+    with open(watermark_path(complete_path) + '.tmp', 'w') as f:
+        json.dump(watermark, f)
+    os.replace(watermark_path(complete_path) + '.tmp', watermark_path(complete_path))
+
+def _load_watermark(complete_path):
+    '''
+    The watermark of a complete dataset, or None if it has to be preprocessed from 
+    scratch. Complete data written before watermarks existed is assumed to match the 
+    raw data up to its last row.
+    '''
+    if not dataset_exists(complete_path):
+        return None
+
+    complete_last_start = read_dataset(complete_path, columns=['start'])['start'].max()
+    if complete_last_start is None:
+        return None
+
+    # Complete data written with the derived columns is rebuilt as OHLCV
+    if scan_dataset(complete_path).collect_schema().names() != kline_columns:
+        return None
+
+    if not os.path.isfile(watermark_path(complete_path)):
+        return {'last_start': complete_last_start, 'raw_hash': None}
+
+    try:
+        with open(watermark_path(complete_path)) as f:
+            watermark = json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+    # Rows were appended to the complete data after the watermark was saved (e.g. an 
+    # interrupted run), so it cannot be trusted
+    if complete_last_start != watermark['last_start']:
+        return None
 
-    for raw_file in raw_data_files:
-        complete_file = raw_file.replace("raw", "complete")
+    return watermark
 
-        if os.path.isfile(os.path.join(preprocessed_data_folder, complete_file)):
-            print(f"The file {complete_file} already exists.")
+def _remove_complete_data_derivatives(complete_path, interval):
+    # Rollups and kline stores of previous complete data that no longer match it
+    exchange, symbol_exchange, _, _ = parse_dataset_path(complete_path)
+    folder = os.path.dirname(complete_path)
+
+    remove_dataset(kline_store_path(folder, exchange, symbol_exchange, interval, 'complete'))
+    for rollup_interval in rollup_intervals:
+        remove_dataset(dataset_path(folder, exchange, symbol_exchange, rollup_interval, 'rollup'))
+        remove_dataset(kline_store_path(folder, exchange, symbol_exchange, rollup_interval, 'rollup'))
+
+def preprocess_dataset(raw_path, complete_path, lookback=24*60*60):
+    '''
+    Preprocess one raw dataset into its complete dataset, incrementally where possible. 
+    A watermark file next to the complete data records the last raw timestamp that was 
+    processed and a hash of the raw rows up to it. If those rows are unchanged, only the 
+    newer raw rows are processed, together with the previous lookback seconds of raw 
+    data as context for the forward-fill and outlier detection. Everything after the 
+    first context row is written again, so a spike before the watermark whose revert 
+    only arrived with the new rows is removed just like in a full recompute. Only a 
+    spike whose jump lies before the context is missed. If the processed rows did 
+    change (e.g. repair_raw_data filled old gaps), the dataset is recomputed from scratch.
+    '''
+    interval = parse_dataset_path(raw_path)[2]
+
+    raw_historical_data = read_dataset(raw_path)
+    if raw_historical_data['volume'].dtype != pl.Float64:
+        raw_historical_data = raw_historical_data.with_columns(raw_historical_data['volume'].cast(pl.Float64).alias('volume'))
+
+    watermark = _load_watermark(complete_path)
+
+    if watermark is not None:
+        processed_raw_data = raw_historical_data.filter(pl.col('start') <= watermark['last_start'])
+
+        if watermark['raw_hash'] is not None and watermark['raw_hash'] != _raw_data_hash(processed_raw_data):
+            print(f"Raw data before the watermark of {complete_path} changed. Preprocessing from scratch")
+            watermark = None
+
+    if watermark is None:
+        write_dataset(preprocess_historical_data(raw_historical_data, interval), complete_path)
+        _remove_complete_data_derivatives(complete_path, interval)
+        _save_watermark(complete_path, raw_historical_data)
+        print(f"Preprocessed {raw_path} -> {complete_path} ({raw_historical_data.height} raw rows)")
+        return
+
+    new_raw_data = raw_historical_data.filter(pl.col('start') > watermark['last_start'])
+
+    if new_raw_data.height == 0:
+        print(f"{complete_path} is up to date")
+        if watermark['raw_hash'] is None:
+            _save_watermark(complete_path, raw_historical_data)
+        return
+
+    context = processed_raw_data.filter(pl.col('start') > watermark['last_start'] - lookback)
+    if context.height < 2:
+        context = processed_raw_data.top_k(2, by='start')
+
+    # The first context row is kept as it is, it has no percent change to judge it by. 
+    # Every later row is on the interval grid after imputation, so the upsert replaces 
+    # each stored row from there on.
+    context = context.sort(by='start')
+    new_complete_data = preprocess_historical_data(pl.concat([context, new_raw_data], how='vertical_relaxed'), interval)\
+        .filter(pl.col('start') > context['start'][0])
+
+    # Rows before the watermark rarely change. When they do, rollups and kline stores 
+    # (which are only updated from their own last rows) are rebuilt.
+    stored_complete_data = scan_dataset(complete_path).filter(pl.col('start') > context['start'][0]).collect().sort(by='start')
+    if not new_complete_data.filter(pl.col('start') <= watermark['last_start']).equals(stored_complete_data):
+        _remove_complete_data_derivatives(complete_path, interval)
+
+    upsert_dataset(new_complete_data, complete_path)
+    _save_watermark(complete_path, raw_historical_data)
+    print(f"Updated {new_complete_data.height} rows of {complete_path}")
+
+# Coarser intervals built from the complete 1m data by rollup_dataset, each from the one
+# before it. Every interval must be a multiple of the one before.
+rollup_intervals = ['5m', '15m', '30m', '1h', '6h', '1d']
+
+def rollup_klines(historical_data, interval):
+    '''
+    Aggregate sorted klines into candles of a coarser interval, in buckets aligned to 
+    UTC (a bucket starts at start - start % interval seconds): first open, max high, 
+    min low, last close and summed volume.
+    '''
+    step = interval_seconds[interval]
+
+    return historical_data.group_by((pl.col('start') - pl.col('start') % step).alias('start'), maintain_order=True).agg(
+        pl.col('low').min(),
+        pl.col('high').max(),
+        pl.col('open').first(),
+        pl.col('close').last(),
+        pl.col('volume').sum()
+    )
+
+def rollup_dataset(complete_path, intervals=None):
+    '''
+    Build the rollup datasets of every interval in rollup_intervals from a complete 1m 
+    dataset, next to it. Each interval is aggregated from the one before it, and all of 
+    them are computed in one collect_all.
+
+    Updates are incremental. Everything from the start of the latest bucket of the 
+    coarsest interval is recomputed and upserted, so the last, possibly unfinished, 
+    buckets are completed as new 1m data lands. preprocess_dataset removes the rollups 
+    whenever it recomputes the complete data from scratch, so they are rebuilt in full.
+    '''
+    intervals = intervals or rollup_intervals
+    exchange, symbol_exchange, interval, _ = parse_dataset_path(complete_path)
+    folder = os.path.dirname(complete_path)
+
+    if interval != '1m':
+        raise ValueError(f"Rollups are built from 1m data, not {interval}")
+
+    rollup_paths = {rollup_interval: dataset_path(folder, exchange, symbol_exchange, rollup_interval, 'rollup') for rollup_interval in intervals}
+
+    # Recompute from the start of the last bucket of the coarsest interval, or from scratch 
+    # if any of the rollups is missing
+    last_starts = [
+        scan_dataset(rollup_path).select(pl.col('start').max()).collect().item() if dataset_exists(rollup_path) else None
+        for rollup_path in rollup_paths.values()
+    ]
+    from_start = None if None in last_starts else min(last_starts)
+
+    complete_data = scan_dataset(complete_path).select(["start", "low", "high", "open", "close", "volume"])
+    if from_start is not None:
+        complete_data = complete_data.filter(pl.col('start') >= from_start)
+
+    rollups = []
+    for rollup_interval in intervals:
+        rollups.append(rollup_klines(rollups[-1] if len(rollups) > 0 else complete_data, rollup_interval))
+    rollups = dict(zip(intervals, pl.collect_all(rollups)))
+
+    for rollup_interval, rollup_data in rollups.items():
+        if rollup_data.height == 0:
             continue
 
-        raw_historical_data = pl.read_csv(os.path.join(raw_data_folder, raw_file))
+        if from_start is None:
+            write_dataset(rollup_data, rollup_paths[rollup_interval])
+        else:
+            upsert_dataset(rollup_data, rollup_paths[rollup_interval])
+
+    print(f"Rolled up {complete_path} into {', '.join(intervals)}" + (f" from {from_start}" if from_start is not None else ""))
+
+def rollup_data(preprocessed_data_folder, intervals=None):
+    '''
+    Build or update the rollups of every complete 1m dataset in preprocessed_data_folder.
+    '''
+    for complete_path in list_datasets(preprocessed_data_folder, 'complete'):
+        if parse_dataset_path(complete_path)[2] == '1m':
+            rollup_dataset(complete_path, intervals)
+
+# Rough peak memory use of preprocess_dataset per raw row, measured on 1m data, and the 
+# smallest number of bytes a raw CSV row takes on disk (used to estimate its row count)
+preprocess_bytes_per_row = 500
+raw_csv_min_bytes_per_row = 50
 
-        if raw_historical_data['volume'].dtype != pl.Float64:
-            raw_historical_data = raw_historical_data.with_columns(raw_historical_data['volume'].cast(pl.Float64).alias('volume'))
+def estimate_preprocess_memory(raw_path):
+    '''
+    Estimate the peak memory in bytes needed to preprocess a raw dataset, without 
+    loading it. Parquet row counts come from the file metadata, CSV row counts are 
+    estimated from the file size.
+    '''
+    if os.path.isdir(raw_path):
+        month_files = glob.glob(os.path.join(raw_path, '*.parquet'))
+        n_rows = pl.scan_parquet(month_files).select(pl.len()).collect().item() if len(month_files) > 0 else 0
+    else:
+        n_rows = os.path.getsize(raw_path) // raw_csv_min_bytes_per_row
+
+    return n_rows * preprocess_bytes_per_row
+
+def _preprocess_dataset_timed(raw_path, complete_path):
+    # Run in a fresh worker process per dataset, so ru_maxrss is the peak of this dataset alone
+    start_time = time.perf_counter()
+    preprocess_dataset(raw_path, complete_path)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return time.perf_counter() - start_time, peak_rss_mb
+
+def preprocess_data(raw_data_folder, preprocessed_data_folder, workers=1, memory_budget_gb=None):
+    '''
+    Preprocess every raw dataset in raw_data_folder into preprocessed_data_folder. 
+    With workers > 1 the datasets are spread over a pool of processes, each dataset in 
+    a fresh process (so scripts calling it need an if __name__ == '__main__' guard). A 
+    dataset is only started if the estimated peak memory of all running datasets (see 
+    estimate_preprocess_memory) stays within memory_budget_gb, although one dataset is 
+    always allowed to run even if it alone exceeds the budget. A failing dataset does 
+    not stop the others. The time and peak memory (or the error) of every dataset are 
+    printed at the end.
+    '''
+    jobs = []
+    for raw_path in list_datasets(raw_data_folder, 'raw'):
+        exchange, symbol_exchange, interval, _ = parse_dataset_path(raw_path)
+        complete_path = dataset_path(preprocessed_data_folder, exchange, symbol_exchange, interval, 'complete')
+        jobs.append((raw_path, complete_path))
+
+    memory_budget = memory_budget_gb * 1024**3 if memory_budget_gb is not None else float('inf')
+    results = []
+    start_time = time.perf_counter()
 
-        # Remove outliers
-        complete_data = remove_outliers(raw_historical_data)
+    if workers == 1:
+        for raw_path, complete_path in jobs:
+            # A failing dataset is reported like in the pool below, without stopping the others
+            try:
+                # Peak memory is that of the whole process so far, not of this dataset alone
+                seconds, peak_rss_mb = _preprocess_dataset_timed(raw_path, complete_path)
+            except Exception as e:
+                print(f"Preprocessing {raw_path} failed: {e!r}")
+                results.append({'dataset': raw_path, 'seconds': None, 'peak_rss_mb': None, 'error': repr(e)})
+            else:
+                results.append({'dataset': raw_path, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'error': None})
+    else:
+        pending = [(raw_path, complete_path, estimate_preprocess_memory(raw_path)) for raw_path, complete_path in jobs]
+        running = {}
 
-        # Impute missing rows
-        complete_data = impute_missing_data(complete_data)
+        # Worker processes are spawned rather than forked, because forking after polars has 
+        # started its thread pool can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=1) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < workers and \
+                        (len(running) == 0 or sum(job[2] for job in running.values()) + pending[0][2] <= memory_budget):
+                    job = pending.pop(0)
+                    running[executor.submit(_preprocess_dataset_timed, job[0], job[1])] = job
 
-        # Add a few more columns that might be useful. (Might as well do it once here 
-        # rather than once for every future strategy to be tested)
-        complete_data = complete_data.with_columns(
-            pl.col("close").pct_change().alias("close_pct_change"),
-            pl.col("close").diff().alias("close_diff"),
-            (pl.col("high") - pl.col("low")).alias("low_high_diff"),
-            (pl.col("high") - pl.col("close")).alias("close_high_diff"),
-            (pl.col("close") - pl.col("low")).alias("low_close_diff")
-        ).with_columns(
-            (pl.col("low_high_diff") / pl.col("close")).alias("low_high_diff_pct"),
-            (pl.col("close_high_diff") / pl.col("close")).alias("close_high_diff_pct"),
-            (pl.col("low_close_diff") / pl.col("close")).alias("low_close_diff_pct")
-        )
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
 
-        complete_data.write_csv(os.path.join(preprocessed_data_folder, complete_file))
+                for future in done:
+                    raw_path = running.pop(future)[0]
+                    if future.exception() is not None:
+                        print(f"Preprocessing {raw_path} failed: {future.exception()!r}")
+                        results.append({'dataset': raw_path, 'seconds': None, 'peak_rss_mb': None, 'error': repr(future.exception())})
+                    else:
+                        seconds, peak_rss_mb = future.result()
+                        results.append({'dataset': raw_path, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'error': None})
+
+    results = pl.DataFrame(results, schema={'dataset': pl.String, 'seconds': pl.Float64, 'peak_rss_mb': pl.Float64, 'error': pl.String})
+    print(f"Preprocessed {len(jobs)} datasets in {round(time.perf_counter() - start_time, 1)} s")
+    with pl.Config(tbl_rows=-1, fmt_str_lengths=100):
+        print(results.with_columns(pl.col('seconds').round(2), pl.col('peak_rss_mb').round(1)))
+
+    return results
 
 def plot_data(data, y_column, file, yscale='linear'):
     """
     Plot the data with 'start' column on the x-axis and the specified column on the y-axis.
 
     Parameters:
-    - data (pd.DataFrame): The DataFrame containing the historical data.
+    - data (pl.DataFrame): The DataFrame containing the historical data.
     - y_column (str): The column name to plot on the y-axis.
     """
+    # matplotlib takes longer to import than everything else in the preprocessing 
+    # path put together, so it is only loaded when something is actually plotted
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(16, 10))
     plt.plot(data['start'], data[y_column], label=y_column)
     plt.xlabel('Timestamp')
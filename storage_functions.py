@@ -0,0 +1,239 @@
+import os
+import glob
+import shutil
+import polars as pl
+from datetime import datetime, timezone
+
+# How datasets are stored on disk. 'parquet' stores every dataset as a directory holding
+# one Parquet file per calendar month, 'csv' as the original single CSV file.
+STORAGE_FORMAT = os.getenv('crypto_storage_format', 'parquet')
+
+# Rows per Parquet row group: one week of 1m candles. Range scans skip the row groups
+# outside of the range by their min/max statistics, so a short range read from a month
+# file only costs about a week of I/O.
+parquet_row_group_size = 10080
+
+
+def dataset_path(folder, exchange, symbol_exchange, interval, stage, storage_format=None):
+    '''
+    Path of the dataset holding one exchange's klines for one symbol and interval. The
+    stage is one of 'partial' and 'raw' (historical_data) or 'complete' (preprocessed_data).
+    For Parquet the path is a directory, partitioned into {yyyy-mm}.parquet files.
+
+    Without a storage_format, a dataset that only exists as a CSV file (e.g. written
+    before Parquet became the default) resolves to that file, so it keeps being read and
+    updated as CSV until migrate_csv_to_parquet converts it.
+    '''
+    name = f'{exchange}_{symbol_exchange}_{interval}_data_{stage}'
+
+    if storage_format is None:
+        path = dataset_path(folder, exchange, symbol_exchange, interval, stage, STORAGE_FORMAT)
+        csv_path = os.path.join(folder, name + '.csv')
+
+        if path != csv_path and not dataset_exists(path) and os.path.isfile(csv_path):
+            return csv_path
+        return path
+
+    if storage_format == 'csv':
+        return os.path.join(folder, name + '.csv')
+    elif storage_format == 'parquet':
+        return os.path.join(folder, name)
+    else:
+        raise ValueError(f"Unknown storage format: {storage_format}")
+
+def parse_dataset_path(path):
+    '''
+    Inverse of dataset_path. Returns (exchange, symbol_exchange, interval, stage). Symbols
+    can contain underscores (e.g. btc_usdt on Digifinex), exchanges and intervals cannot.
+    '''
+    name = os.path.basename(os.path.normpath(path))
+    if name.endswith('.csv'):
+        name = name[:-len('.csv')]
+
+    exchange_symbol, interval, _, stage = name.rsplit('_', 3)
+    exchange, symbol_exchange = exchange_symbol.split('_', 1)
+
+    return exchange, symbol_exchange, interval, stage
+
+def list_datasets(folder, stage, storage_format=None):
+    '''
+    Paths of all datasets of the given stage in folder, in the given storage format.
+    Without a storage_format, the datasets in STORAGE_FORMAT are listed together with
+    the CSV datasets that do not exist in STORAGE_FORMAT, as dataset_path resolves them.
+    '''
+    if storage_format is None:
+        paths = list_datasets(folder, stage, STORAGE_FORMAT)
+        if STORAGE_FORMAT != 'csv':
+            paths += [path for path in list_datasets(folder, stage, 'csv') if path.removesuffix('.csv') not in paths]
+        return sorted(paths)
+
+    pattern = f'*_data_{stage}.csv' if storage_format == 'csv' else f'*_data_{stage}'
+
+    return sorted(path for path in glob.glob(os.path.join(folder, pattern)) if storage_format == 'csv' or os.path.isdir(path))
+
+def _restore_interrupted_write(path):
+    # write_dataset was interrupted after moving the old Parquet dataset aside
+    if not os.path.exists(path) and os.path.isdir(path + '.old'):
+        os.rename(path + '.old', path)
+
+def dataset_exists(path):
+    _restore_interrupted_write(path)
+    return os.path.exists(path)
+
+def _month_files(path):
+    return sorted(glob.glob(os.path.join(path, '*.parquet')))
+
+def _month_of():
+    return pl.from_epoch('start', time_unit='s').dt.strftime('%Y-%m').alias('month')
+
+def read_dataset(path, columns=None):
+    '''
+    Read a whole dataset. Only the requested columns are read from disk, which for
+    Parquet means the other columns are never parsed at all.
+    '''
+    _restore_interrupted_write(path)
+
+    if not os.path.isdir(path):
+        return pl.read_csv(path, columns=columns)
+
+    month_files = _month_files(path)
+    if len(month_files) == 0:
+        return pl.DataFrame(schema=columns or ["start", "low", "high", "open", "close", "volume"])
+
+    historical_data = pl.scan_parquet(month_files)
+    if columns is not None:
+        historical_data = historical_data.select(columns)
+
+    return historical_data.collect()
+
+def scan_dataset(path, start=None, end=None):
+    '''
+    Lazily scan a dataset, so that filters and column selections applied before
+    collecting are pushed down into the reader. With start and/or end (unix timestamps,
+    end exclusive) only the rows in between are scanned, and for Parquet the month files
+    outside of the range are not opened at all.
+    '''
+    _restore_interrupted_write(path)
+
+    if not os.path.isdir(path):
+        historical_data = pl.scan_csv(path)
+    else:
+        month_files = _month_files(path)
+        if start is not None:
+            first_month = datetime.fromtimestamp(start, timezone.utc).strftime('%Y-%m')
+            month_files = [f for f in month_files if os.path.basename(f)[:7] >= first_month]
+        if end is not None:
+            last_month = datetime.fromtimestamp(end - 1, timezone.utc).strftime('%Y-%m')
+            month_files = [f for f in month_files if os.path.basename(f)[:7] <= last_month]
+
+        if len(month_files) == 0:
+            return pl.LazyFrame(schema=["start", "low", "high", "open", "close", "volume"])
+
+        historical_data = pl.scan_parquet(month_files)
+
+    if start is not None:
+        historical_data = historical_data.filter(pl.col('start') >= start)
+    if end is not None:
+        historical_data = historical_data.filter(pl.col('start') < end)
+
+    return historical_data
+
+def write_dataset(historical_data, path):
+    '''
+    Write a whole dataset, replacing whatever was stored at path before. The new data is
+    written next to the old and then renamed into place, so an interruption never leaves
+    a partly written dataset behind.
+    '''
+    _restore_interrupted_write(path)
+
+    tmp_path = path + '.tmp'
+    remove_dataset(tmp_path)
+    remove_dataset(path + '.old')
+
+    if not path.endswith('.csv'):
+        os.makedirs(tmp_path)
+        _write_months(historical_data, tmp_path)
+
+        # A directory cannot be replaced in one rename, so the old one is moved aside
+        # first. If interrupted in between, the old one is restored on the next read.
+        if os.path.isdir(path):
+            os.rename(path, path + '.old')
+        os.rename(tmp_path, path)
+        remove_dataset(path + '.old')
+    else:
+        historical_data.write_csv(tmp_path)
+        os.replace(tmp_path, path)
+
+def append_dataset(historical_data, path):
+    '''
+    Append rows to a dataset, creating it if it does not exist yet. For Parquet only the
+    months the new rows fall in are rewritten, and rows whose start is already stored are
+    replaced by the new ones.
+    '''
+    if not path.endswith('.csv'):
+        os.makedirs(path, exist_ok=True)
+        _write_months(historical_data, path, merge=True)
+    elif not os.path.isfile(path):
+        historical_data.write_csv(path)
+    else:
+        with open(path, 'a') as f:
+            historical_data.write_csv(f, include_header=False)
+
+def upsert_dataset(historical_data, path):
+    '''
+    Write rows to a dataset, replacing every stored row from the first new start on. For
+    Parquet this is an append, as only the affected months are rewritten anyway.
+    '''
+    if not path.endswith('.csv'):
+        append_dataset(historical_data, path)
+    elif not os.path.isfile(path) or historical_data.height == 0:
+        append_dataset(historical_data, path)
+    else:
+        stored_data = pl.read_csv(path).filter(pl.col('start') < historical_data['start'].min())
+        write_dataset(pl.concat([stored_data, historical_data], how='vertical_relaxed'), path)
+
+def _write_months(historical_data, path, merge=False):
+    if historical_data.height == 0:
+        return
+
+    months = historical_data.with_columns(_month_of()).partition_by('month', as_dict=True, include_key=False)
+
+    for (month,), month_data in months.items():
+        month_file = os.path.join(path, f'{month}.parquet')
+
+        if merge and os.path.isfile(month_file):
+            month_data = pl.concat([pl.read_parquet(month_file), month_data], how='vertical_relaxed')\
+                .unique(subset=['start'], keep='last')
+
+        month_data.sort(by='start').write_parquet(month_file + '.tmp', row_group_size=parquet_row_group_size)
+        os.replace(month_file + '.tmp', month_file)
+
+def move_dataset(path, new_path):
+    # Between formats, e.g. a CSV partial dataset that becomes a Parquet raw dataset
+    if path.endswith('.csv') != new_path.endswith('.csv'):
+        write_dataset(read_dataset(path), new_path)
+        remove_dataset(path)
+    else:
+        os.rename(path, new_path)
+
+def remove_dataset(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+def migrate_csv_to_parquet(folder, remove_csv=False):
+    '''
+    One-shot conversion of every CSV dataset in folder (raw, partial and complete files)
+    to the partitioned Parquet layout. CSV files are kept unless remove_csv is set.
+    '''
+    for csv_path in sorted(glob.glob(os.path.join(folder, '*_data_*.csv'))):
+        exchange, symbol_exchange, interval, stage = parse_dataset_path(csv_path)
+        parquet_path = dataset_path(folder, exchange, symbol_exchange, interval, stage, storage_format='parquet')
+
+        historical_data = pl.read_csv(csv_path)
+        write_dataset(historical_data, parquet_path)
+        print(f"Migrated {csv_path} -> {parquet_path} ({historical_data.height} rows)")
+
+        if remove_csv:
+            os.remove(csv_path)
@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import polars as pl
+from exchange_maps import *
+from storage_functions import *
+from kline_store_functions import *
+from backtest_functions import *
+
+# A sweep backtests a strategy with every combination of a parameter grid on every
+# dataset, in walk-forward windows. The candles of every dataset are loaded once into
+# shared memory, which the worker processes map instead of loading their own copy. One
+# task is one strategy and parameter combination on one dataset: the positions are
+# computed once over the whole dataset and backtested in every window. The result of
+# every task is appended to a JSONL file as one line as soon as it is done, so an
+# interrupted sweep continues with the tasks that have no line yet. A task is identified
+# by its dataset, strategy and parameters together with the sweep settings (interval,
+# range, windows and trading costs), so a rerun with other settings runs everything again
+# instead of taking the results of the old settings for its own.
+
+
+#------------------------------------------------------------
+# Strategies
+# Each takes the market data of one dataset (a dict of read-only arrays: start and the
+# loaded columns) and its parameters, and returns the target position per candle
+
+def rolling_mean(values, window):
+    '''
+    Mean of the last window values at every index, NaN for the first window - 1.
+    '''
+    sums = np.cumsum(values)
+    means = np.full(len(values), np.nan)
+    means[window - 1:] = (sums[window - 1:] - np.concatenate([[0.0], sums[:-window]])) / window
+    return means
+
+def sma_crossover(market, fast, slow, allow_short=True):
+    '''
+    Long while the fast moving average of the close is above the slow one, short (or
+    flat if allow_short is False) while it is below.
+    '''
+    difference = rolling_mean(market['close'], fast) - rolling_mean(market['close'], slow)
+    return np.where(difference > 0, 1.0, -1.0 if allow_short else 0.0) * ~np.isnan(difference)
+
+strategies = {
+    'sma_crossover': sma_crossover
+}
+
+#------------------------------------------------------------
+# Grids and windows
+
+def parameter_grid(grid, condition=None):
+    '''
+    Every combination of a dict of parameter lists, as a list of dicts, optionally only
+    those for which condition(params) is True.
+    '''
+    combinations = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    return [params for params in combinations if condition is None or condition(params)]
+
+def walk_forward_windows(first_start, last_start, train_days=None, test_days=None):
+    '''
+    Rolling [start, end) ranges of a train period followed by a test period, moving by
+    test_days until the test period passes last_start. Without train_days the whole
+    range is a single test window.
+
+    :return: List of dicts with train_start, train_end, test_start and test_end
+    '''
+    if train_days is None:
+        return [{'train_start': None, 'train_end': None, 'test_start': int(first_start), 'test_end': int(last_start) + 1}]
+
+    windows = []
+    train_start = int(first_start)
+
+    while train_start + (train_days + test_days) * 86400 <= last_start + 1:
+        test_start = train_start + train_days * 86400
+        windows.append({'train_start': train_start, 'train_end': test_start, 'test_start': test_start, 'test_end': test_start + test_days * 86400})
+        train_start += test_days * 86400
+
+    return windows
+
+#------------------------------------------------------------
+# Shared market data
+
+# The market data of every dataset in this process, by dataset key, and the shared
+# memory blocks backing it
+_markets = {}
+_market_blocks = []
+
+def _dataset_key(symbol, exchange):
+    return f'{symbol}_{exchange}'
+
+def share_market(historical_data, columns):
+    '''
+    Copy the start column and columns of a DataFrame into a new shared memory block:
+    start as int64 followed by one float64 row per column.
+
+    :return: (block, spec), the spec being what attach_market needs to map it
+    '''
+    n_rows = historical_data.height
+    block = shared_memory.SharedMemory(create=True, size=max(8 * n_rows * (1 + len(columns)), 1))
+
+    np.ndarray(n_rows, dtype=np.int64, buffer=block.buf)[:] = historical_data['start'].to_numpy()
+    values = np.ndarray((len(columns), n_rows), dtype=np.float64, buffer=block.buf, offset=8 * n_rows)
+    for i, column in enumerate(columns):
+        values[i] = historical_data[column].to_numpy()
+
+    return block, {'name': block.name, 'rows': n_rows, 'columns': list(columns)}
+
+def attach_market(spec):
+    '''
+    Map a block created by share_market, as a dict of read-only arrays.
+    '''
+    block = shared_memory.SharedMemory(name=spec['name'])
+    _market_blocks.append(block)
+
+    market = {'start': np.ndarray(spec['rows'], dtype=np.int64, buffer=block.buf)}
+    values = np.ndarray((len(spec['columns']), spec['rows']), dtype=np.float64, buffer=block.buf, offset=8 * spec['rows'])
+    for i, column in enumerate(spec['columns']):
+        market[column] = values[i]
+
+    for array in market.values():
+        array.flags.writeable = False
+
+    return market
+
+def _attach_markets(specs):
+    # Initializer of the worker processes
+    for key, spec in specs.items():
+        _markets[key] = attach_market(spec)
+
+#------------------------------------------------------------
+# Tasks
+
+def sweep_settings(interval, stage, start, end, train_days, test_days, fee, slippage, execution):
+    '''
+    The arguments of run_sweep besides the datasets, strategy and parameters that change
+    the results of a task.
+    '''
+    return {
+        'interval': interval,
+        'stage': stage,
+        'start': None if start is None else to_timestamp(start),
+        'end': None if end is None else to_timestamp(end),
+        'train_days': train_days,
+        'test_days': test_days,
+        'fee': fee,
+        'slippage': slippage,
+        'execution': execution
+    }
+
+def task_key(symbol, exchange, strategy, params, settings):
+    return f"{_dataset_key(symbol, exchange)}|{strategy}|{json.dumps(params, sort_keys=True)}|{json.dumps(settings, sort_keys=True)}"
+
+def _segment_stats(market, positions, first, end, backtest_settings):
+    rows = slice(*np.searchsorted(market['start'], [first, end]))
+    if rows.stop - rows.start < 2:
+        return None
+
+    window_data = pl.DataFrame({'start': market['start'][rows], 'open': market['open'][rows], 'close': market['close'][rows]})
+    return run_backtest(window_data, positions[rows], **backtest_settings)['stats']
+
+def run_sweep_task(symbol, exchange, strategy, params, settings):
+    '''
+    Backtest one parameter combination on one dataset in every walk-forward window.
+    Runs in the worker processes, on the market data attached by their initializer.
+
+    :return: Result line of the task
+    '''
+    market = _markets[_dataset_key(symbol, exchange)]
+    positions = strategies[strategy](market, **params)
+    train_days, test_days = settings['train_days'], settings['test_days']
+    backtest_settings = {name: settings[name] for name in ['fee', 'slippage', 'execution']}
+
+    windows = []
+    for i, window in enumerate(walk_forward_windows(market['start'][0], market['start'][-1], train_days, test_days)):
+        windows.append({
+            'window': i,
+            **window,
+            'train': _segment_stats(market, positions, window['train_start'], window['train_end'], backtest_settings) if train_days is not None else None,
+            'test': _segment_stats(market, positions, window['test_start'], window['test_end'], backtest_settings)
+        })
+
+    return {
+        'task': task_key(symbol, exchange, strategy, params, settings),
+        'symbol': symbol,
+        'exchange': exchange,
+        'strategy': strategy,
+        'params': params,
+        'settings': settings,
+        'windows': windows
+    }
+
+def completed_tasks(results_file):
+    '''
+    Keys of the tasks with a complete line in results_file. A line cut off by an
+    interruption does not count.
+    '''
+    tasks = set()
+    if not os.path.isfile(results_file):
+        return tasks
+
+    with open(results_file) as f:
+        for line in f:
+            try:
+                tasks.add(json.loads(line)['task'])
+            except (json.JSONDecodeError, KeyError):
+                pass
+
+    return tasks
+
+#------------------------------------------------------------
+# Sweep
+
+def run_sweep(strategy, params_list, results_file, symbols=None, exchanges=None, interval='1m', start=None, end=None,
+              train_days=None, test_days=None, workers=1, columns=('open', 'close'), folder='preprocessed_data', stage='complete',
+              fee=0.001, slippage=0.0005, execution='next_open'):
+    '''
+    Backtest a strategy with every parameter combination on every dataset, streaming the
+    results to results_file. Tasks already in results_file with the same settings are
+    skipped, so rerunning an interrupted sweep with the same arguments continues it.
+    With workers > 1 the tasks run on a pool of spawned processes (so scripts calling it
+    need an if __name__ == '__main__' guard).
+
+    :param strategy: Name of the strategy in strategies
+    :param params_list: List of parameter dicts, e.g. from parameter_grid
+    :param results_file: JSONL file the results are appended to
+    :param symbols: Symbols to include (default: all of symbol_map)
+    :param exchanges: Exchanges to include (default: all exchanges of every symbol)
+    :param interval: The interval of the candles
+    :param start: First candle, as 'yyyy-mm-dd' or a unix timestamp (default: the first stored)
+    :param end: End of the range, exclusive (default: after the last stored)
+    :param train_days: Length of the train period of the walk-forward windows (default:
+        no walk-forward, one test window over the whole range)
+    :param test_days: Length of the test period, and step, of the walk-forward windows
+    :param workers: Number of worker processes
+    :param columns: Candle columns the strategy needs besides start (open and close are
+        always needed by the backtest)
+    :param folder: Folder of the datasets
+    :param stage: Stage of the datasets, e.g. 'rollup' for intervals above 1m
+    :param fee: Fee per trade, see run_backtest
+    :param slippage: Slippage per trade, see run_backtest
+    :param execution: Execution of the positions, see run_backtest
+    :return: Number of tasks run
+    '''
+    symbols = symbols or list(symbol_map.keys())
+    columns = list(dict.fromkeys(['open', 'close'] + list(columns)))
+    settings = sweep_settings(interval, stage, start, end, train_days, test_days, fee, slippage, execution)
+    done = completed_tasks(results_file)
+
+    datasets = []
+    for symbol in symbols:
+        for exchange in exchanges or symbol_map[symbol].keys():
+            if exchange in symbol_map[symbol] and dataset_exists(dataset_path(folder, exchange, symbol_map[symbol][exchange], interval, stage)):
+                datasets.append((symbol, exchange))
+
+    tasks = [(symbol, exchange, params) for symbol, exchange in datasets for params in params_list
+             if task_key(symbol, exchange, strategy, params, settings) not in done]
+    if len(tasks) == 0:
+        print(f"All {len(datasets) * len(params_list)} tasks are in {results_file}")
+        return 0
+
+    # Every dataset with pending tasks is loaded once, into shared memory
+    blocks = []
+    specs = {}
+    start_time = time.perf_counter()
+
+    try:
+        for symbol, exchange in dict.fromkeys((symbol, exchange) for symbol, exchange, _ in tasks):
+            block, spec = share_market(load_klines(symbol, exchange, interval, start, end, columns, folder, stage), columns)
+            blocks.append(block)
+            specs[_dataset_key(symbol, exchange)] = spec
+
+        print(f"Loaded {len(specs)} datasets, running {len(tasks)} tasks ({len(done)} already done)")
+
+        os.makedirs(os.path.dirname(results_file) or '.', exist_ok=True)
+        with open(results_file, 'a') as f:
+            # Finish a line cut off by an interruption, so it does not swallow the next one
+            if f.tell() > 0:
+                with open(results_file, 'rb') as check:
+                    check.seek(-1, os.SEEK_END)
+                    if check.read(1) != b'\n':
+                        f.write('\n')
+
+            def write_result(result):
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+
+            if workers == 1:
+                _attach_markets(specs)
+                for symbol, exchange, params in tasks:
+                    write_result(run_sweep_task(symbol, exchange, strategy, params, settings))
+            else:
+                # Spawned rather than forked, as in preprocess_data. At most two tasks per
+                # worker are queued, so results are written as they come in
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_attach_markets, initargs=(specs,)) as executor:
+                    pending = list(tasks)
+                    running = set()
+
+                    while len(pending) > 0 or len(running) > 0:
+                        while len(pending) > 0 and len(running) < 2 * workers:
+                            symbol, exchange, params = pending.pop(0)
+                            running.add(executor.submit(run_sweep_task, symbol, exchange, strategy, params, settings))
+
+                        finished, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            write_result(future.result())
+    finally:
+        _markets.clear()
+        for block in _market_blocks + blocks:
+            block.close()
+        _market_blocks.clear()
+        for block in blocks:
+            block.unlink()
+
+    print(f"Ran {len(tasks)} tasks in {round(time.perf_counter() - start_time, 1)} s")
+
+    return len(tasks)
+
+#------------------------------------------------------------
+# Results
+
+def sweep_results(results_file):
+    '''
+    The results of a sweep as one row per task, window and segment ('train' or 'test'),
+    with the sweep settings (as JSON in 'settings'), the parameters (as JSON in 'params'
+    and one column each) and statistics as columns.
+    '''
+    rows = []
+
+    with open(results_file) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            for window in result['windows']:
+                for segment in ['train', 'test']:
+                    if window[segment] is not None:
+                        rows.append({
+                            'symbol': result['symbol'], 'exchange': result['exchange'], 'strategy': result['strategy'],
+                            'settings': json.dumps(result.get('settings'), sort_keys=True),
+                            'params': json.dumps(result['params'], sort_keys=True), **result['params'],
+                            'window': window['window'], 'segment': segment,
+                            'start': window[f'{segment}_start'], 'end': window[f'{segment}_end'], **window[segment]
+                        })
+
+    return pl.DataFrame(rows)
+
+def walk_forward_report(results_file, metric='sharpe'):
+    '''
+    Out-of-sample performance of a walk-forward sweep: for every dataset, window and
+    settings, the parameters with the best train metric and their statistics in the test
+    period.
+    '''
+    results = sweep_results(results_file)
+
+    best = results.filter(pl.col('segment') == 'train').sort(metric, descending=True)\
+        .unique(subset=['symbol', 'exchange', 'settings', 'window'], keep='first').select('symbol', 'exchange', 'settings', 'window', 'params')
+
+    return results.filter(pl.col('segment') == 'test').join(best, on=['symbol', 'exchange', 'settings', 'window', 'params'])\
+        .sort(['symbol', 'exchange', 'window'])